@@ -94,10 +94,29 @@ def trans_mat(t, r, s):
     return m
 
 class BESMesh(object):
+    """
+    Mesh with vertex attributes in contiguous arrays - positions and normals
+    (count x 3 float32) and uv coords (count x texture count x 2 float32).
+    Vertices are kept as structured array (see BESVertex.dtype)
+    """
     def __init__(self, vertices, faces, material):
+        from numpy import ascontiguousarray, zeros, float32
+
         self.vertices = vertices
         self.faces = faces
         self.material = material
+        self.positions = ascontiguousarray(vertices["position"])
+        self.normals = ascontiguousarray(vertices["normal"])
+        if "uv" in vertices.dtype.names:
+            self.uvs = ascontiguousarray(vertices["uv"])
+        else:
+            self.uvs = zeros((len(vertices), 0, 2), float32)
+
+    def vertex_objects(self):
+        """ Return list of BESVertex instances (one object per vertex) """
+        return [BESVertex(tuple(coords), tuple(normals), [tuple(uv) for uv in uvs])
+            for (coords, normals, uvs) in zip(self.positions.tolist(),
+                self.normals.tolist(), self.uvs.tolist())]
 
 class BESVertex(object):
     class Flags:
@@ -123,6 +142,19 @@ class BESVertex(object):
         self.normals = normals
         self.uv = uv
 
+    def dtype(flags):
+        """
+        Return numpy structured dtype of single vertex with given flags:
+        x,y,z coords, normals and uv coords of each texture
+        """
+        from numpy import dtype
+
+        texCnt = (flags & BESVertex.Flags.TexcountMask) >> BESVertex.Flags.TexcountShift
+        fields = [("position", "<f4", (3,)), ("normal", "<f4", (3,))]
+        if texCnt:
+            fields.append(("uv", "<f4", (texCnt, 2)))
+        return dtype(fields)
+
 class BES(object):
     class Header:
         sig = b'BES\x00'
@@ -204,6 +236,9 @@ class BES(object):
         self.faces = []
         self.data = data
         self.ver = b'0100'
+        self.blocks = []
+        self.children = dict()
+        self.overrun = set()
 
     def unpack(fmt, data):
         st_fmt = fmt
@@ -239,20 +274,81 @@ class BES(object):
         return self.data[0x10:0x3010]
 
     def parse_data(self):
+        self.index_blocks(0x3010)
         res = self.parse_blocks({BES.BlockID.Object  : BES.BlockPresence.ReqSingle,
                     BES.BlockID.Info : BES.BlockPresence.OptSingle},
-                    self.data[0x3010:], 0)
+                    -1, 0)
 
     def parse_block_desc(self, data):
         return BES.unpack("<II", data)
 
-    def parse_block_by_label(self, label, subblock, index):
+    def children_offset(self, label, data, offset, size):
+        """
+        Return offset of nested blocks of container block at given offset
+        (or None if block of this label contains no blocks)
+        """
+        if label == BES.BlockID.Object:
+            if size < 16:
+                return offset + size
+            (children, name_size) = struct.unpack_from("<II", data, offset + 8)
+            return offset + 16 + name_size
+        elif label in [BES.BlockID.Model, BES.BlockID.Mesh, BES.BlockID.Material]:
+            return offset + 12
+        return None
+
+    def index_blocks(self, start):
+        """
+        Build flat index of all blocks in single pass over data from start.
+        Every block is described by tuple (label, offset, size, parent, depth),
+        where offset points to block descriptor, size includes the descriptor
+        and parent is position of enclosing block in the index (-1 for top
+        level blocks). Positions of nested blocks are kept in children dictionary
+        by parent, parents whose nested blocks do not fit them are kept in overrun
+        (such blocks are truncated, their declared sizes are kept in declared
+        by position, for messages)
+        """
+        data = memoryview(self.data)
+        self.blocks = []
+        self.children = {-1: []}
+        self.overrun = set()
+        self.declared = dict()
+
+        regions = [(start, len(data), -1, 0)]
+        while regions:
+            (pos, end, parent, depth) = regions.pop()
+            children = self.children.setdefault(parent, [])
+            if pos > end:
+                self.overrun.add(parent)
+            while pos < end:
+                if end - pos < 8:
+                    self.overrun.add(parent)
+                    break
+                (label, size) = struct.unpack_from("<II", data, pos)
+                if size < 8:
+                    self.overrun.add(parent)
+                    break
+                blockID = len(self.blocks)
+                if pos + size > end:
+                    # keep truncated block, so its content is still checked
+                    self.overrun.add(parent)
+                    self.declared[blockID] = size
+                    size = end - pos
+
+                self.blocks.append((label, pos, size, parent, depth))
+                children.append(blockID)
+
+                childrenPos = self.children_offset(label, data, pos, size)
+                if childrenPos is not None:
+                    regions.append((childrenPos, pos + size, blockID, depth + 1))
+                pos += size
+
+    def parse_block_by_label(self, label, subblock, index, blockID):
         if   label == BES.BlockID.Object:
-            return self.parse_block_object(subblock, index)
+            return self.parse_block_object(subblock, index, blockID)
         elif label == BES.BlockID.Model:
-            return self.parse_block_model(subblock, index)
+            return self.parse_block_model(subblock, index, blockID)
         elif label == BES.BlockID.Mesh:
-            return self.parse_block_mesh(subblock, index)
+            return self.parse_block_mesh(subblock, index, blockID)
         elif label == BES.BlockID.Vertices:
             return self.parse_block_vertices(subblock, index)
         elif label == BES.BlockID.Faces:
@@ -268,7 +364,7 @@ class BES(object):
         elif label == BES.BlockID.Info:
             return self.parse_block_info(subblock, index)
         elif label == BES.BlockID.Material:
-            return self.parse_block_material(subblock, index)
+            return self.parse_block_material(subblock, index, blockID)
         elif label == BES.BlockID.Standard:
             return self.parse_block_standard(subblock, index)
         elif label == BES.BlockID.PteroMat:
@@ -277,22 +373,22 @@ class BES(object):
             logging.warning("Unknown block {}".format(hex(label)))
             hex_dump(subblock, index)
 
-    def get_block_labels(self, data, index):
+    def get_block_labels(self, parent):
         blocks = dict()
-        # Search for all blocks
-        start = 0
-        while len(data[start:]) > 0:
-            (label, size) = self.parse_block_desc(data[start:])
-
+        for blockID in self.children.get(parent, []):
+            label = self.blocks[blockID][0]
             if label not in blocks:
                 blocks[label] = 1
             else:
                 blocks[label] = blocks[label] + 1
-            start += size
 
         return blocks
 
-    def parse_blocks(self, blocks, data, index):
+    def parse_blocks(self, blocks, parent, index):
+        """
+        Parse blocks nested in block at position parent of the index
+        (-1 for top level blocks), see index_blocks
+        """
         # Init return values
         cnt = dict()
         ret = dict()
@@ -304,25 +400,24 @@ class BES(object):
             else:
                 ret[label] = []
 
-        # Search for all blocks
-        start = 0
-        while len(data[start:]) > 0:
-            (label, size) = self.parse_block_desc(data[start:])
-            subblock = data[start + 8: start + size]
+        data = memoryview(self.data)
+        label = 0
+        for blockID in self.children.get(parent, []):
+            (label, offset, size, parentID, depth) = self.blocks[blockID]
+            subblock = data[offset + 8:offset + size]
 
             if label not in blocks:
                 logging.warning("{}Unexpected block {:04X} [{} B] at this location".format(
-                    " "*(index*2), label, size))
+                    " "*(index*2), label, self.declared.get(blockID, size)))
             else:
                 cnt[label] += 1
                 if (blocks[label] == BES.BlockPresence.OptSingle or
                 blocks[label] == BES.BlockPresence.ReqSingle):
-                    ret[label] = self.parse_block_by_label(label, subblock, index)
+                    ret[label] = self.parse_block_by_label(label, subblock, index, blockID)
                 else:
-                    ret[label].append(self.parse_block_by_label(label, subblock, index))
-            start += size
+                    ret[label].append(self.parse_block_by_label(label, subblock, index, blockID))
 
-        if start != len(data):
+        if parent in self.overrun:
             logging.error("{}Block {:04X} contains more data than expected".format(
                 " "*(index*2), label))
 
@@ -337,30 +432,30 @@ class BES(object):
 
         return ret
 
-    def parse_block_object(self, data, index):
+    def parse_block_object(self, data, index, blockID):
         (children, name_size) = BES.unpack("<II", data)
         (name,) = BES.unpack("<" + str(name_size) + "s", data[8:])
         logging.log(logging.VERBOSE, "{}Object ({} B) - children: {}, name({}): {}".format(
             " "*(index*2), len(data), children, name_size,    pchar_to_string(name)))
 
-        blocks = self.get_block_labels(data[8 + name_size:], index + 1)
+        blocks = self.get_block_labels(blockID)
         if index == 0:
             res = self.parse_blocks({
                     BES.BlockID.Object         : BES.BlockPresence.ReqMultiple,
                     BES.BlockID.Material       : BES.BlockPresence.ReqSingle},
-                    data[8 + name_size:], index + 1)
+                    blockID, index + 1)
         elif BES.BlockID.Model in blocks:
             res = self.parse_blocks({
                     BES.BlockID.Object         : BES.BlockPresence.OptMultiple,
                     BES.BlockID.Model          : BES.BlockPresence.ReqSingle},
-                    data[8 + name_size:], index + 1)
+                    blockID, index + 1)
         elif BES.BlockID.Unk38 in blocks:
             res = self.parse_blocks({
                     BES.BlockID.Object         : BES.BlockPresence.OptSingle,
                     BES.BlockID.Properties     : BES.BlockPresence.ReqSingle,
                     BES.BlockID.Transformation : BES.BlockPresence.ReqSingle,
                     BES.BlockID.Unk38          : BES.BlockPresence.ReqSingle},
-                    data[8 + name_size:], index + 1)
+                    blockID, index + 1)
         else:
             logging.error("{}Unexpected object block children".format(
                 " "*(index*2)))
@@ -370,7 +465,7 @@ class BES(object):
             logging.error("{}Number of object children does not match".format(
                 " "*(index*2)))
 
-    def parse_block_model(self, data, index):
+    def parse_block_model(self, data, index, blockID):
         (children,) = BES.unpack("<I", data)
         logging.log(logging.VERBOSE, "{}Model ({} B) - Number of meshes: {:08x}".format(
             " "*(index*2), len(data), children))
@@ -379,13 +474,13 @@ class BES(object):
                     BES.BlockID.Properties     : BES.BlockPresence.ReqSingle,
                     BES.BlockID.Transformation : BES.BlockPresence.ReqSingle,
                     BES.BlockID.Unk36          : BES.BlockPresence.OptSingle},
-                    data[4:], index + 1)
+                    blockID, index + 1)
 
         if len(res[BES.BlockID.Mesh]) != children:
             logging.error("{}Number of model children does not match".format(
                 " "*(index*2)))
 
-    def parse_block_mesh(self, data, index):
+    def parse_block_mesh(self, data, index, blockID):
         """ Parse Mesh block and return BESMesh instance """
         (material,) = BES.unpack("<I", data)
         logging.log(logging.VERBOSE, "{}Mesh ({} B) - Material: {:08x}".format(
@@ -393,28 +488,76 @@ class BES(object):
 
         res = self.parse_blocks({BES.BlockID.Vertices : BES.BlockPresence.ReqSingle,
                     BES.BlockID.Faces       : BES.BlockPresence.ReqSingle},
-                    data[4:], index + 1)
+                    blockID, index + 1)
 
         vertices = res[BES.BlockID.Vertices]
         faces    = res[BES.BlockID.Faces]
+        if vertices is None or faces is None:
+            return None
 
-        maxVertexID = max(max(faces, key=lambda item:item[1]))
-        if maxVertexID >= len(vertices):
-            logging.error("{}Vertex ID ({}) bigger than total number of vertices ({})".format(
-                " "*(index*2), maxVertexID, len(vertices)))
+        self.check_faces(faces, len(vertices), index)
 
         return BESMesh(vertices, faces, material)
 
+    def check_faces(self, faces, count, index):
+        """
+        Check that faces (N x 3 array of vertex IDs) refer only to existing
+        vertices and warn about degenerate and duplicate faces and about
+        vertices not referenced by any face
+        """
+        from numpy import bincount, count_nonzero, lexsort, stack, uint64, where
+
+        if len(faces) == 0:
+            if count:
+                logging.warning("{}Mesh without faces has {} vertices".format(
+                    " "*(index*2), count))
+            return
+
+        maxVertexID = int(faces.max())
+        if maxVertexID >= count:
+            logging.error("{}Vertex ID ({}) bigger than total number of vertices ({}) in {} faces".format(
+                " "*(index*2), maxVertexID, count, count_nonzero((faces >= count).any(axis=1))))
+
+        degenerate = count_nonzero((faces[:, 0] == faces[:, 1]) |
+            (faces[:, 1] == faces[:, 2]) | (faces[:, 0] == faces[:, 2]))
+        if degenerate:
+            logging.warning("{}Degenerate faces: {}".format(" "*(index*2), degenerate))
+
+        # rotate faces to start with the lowest ID, so only faces of the same winding match
+        (a, b, c) = faces.T.astype(uint64)
+        first = (a <= b) & (a <= c)
+        second = ~first & (b <= c)
+        (a, b, c) = (where(first, a, where(second, b, c)), where(first, b, where(second, c, a)),
+            where(first, c, where(second, a, b)))
+        if maxVertexID < (1 << 21):
+            # pack whole face into single sortable key
+            keys = (a << uint64(42)) | (b << uint64(21)) | c
+            keys.sort()
+            duplicate = count_nonzero(keys[1:] == keys[:-1])
+        else:
+            rotated = stack([a, b, c], axis=1)[lexsort((c, b, a))]
+            duplicate = count_nonzero((rotated[1:] == rotated[:-1]).all(axis=1))
+        if duplicate:
+            logging.warning("{}Duplicate faces: {}".format(" "*(index*2), duplicate))
+
+        ids = faces.ravel()
+        unreferenced = count_nonzero(bincount(ids[ids < count], minlength=count) == 0)
+        if unreferenced:
+            logging.warning("{}Vertices not referenced by any face: {}".format(
+                " "*(index*2), unreferenced))
+
     def parse_block_vertices(self, data, index):
         """
-        Parse Vertices block and return list of BESVertex instances.
-        Each instance is made of  x,y,z coords, normals and uv coords (variable length)
+        Parse Vertices block and return structured array of vertices (see BESVertex.dtype).
+        Each vertex is made of x,y,z coords, normals and uv coords (variable length)
         """
+        from numpy import frombuffer
+
         (count, size, flags) = BES.unpack("<III", data)
         texCnt = (flags & BESVertex.Flags.TexcountMask) >> BESVertex.Flags.TexcountShift
         flagsMin = BESVertex.Flags.XYZ | BESVertex.Flags.Normal
         flagsMax = flagsMin | BESVertex.Flags.TexcountMask
-        vertices = []
+        vertices = frombuffer(b'', BESVertex.dtype(flagsMin))
 
         logging.log(logging.VERBOSE, "{}Vertices ({} B) - count: {}, size: {}, flags: {:08x}".format(
             " "*(index*2), len(data), count, size, flags))
@@ -431,51 +574,32 @@ class BES(object):
             logging.error("{}Vertex size do not match".format(
                 " "*(index*2)))
             return vertices
-        elif len(data[12:]) != size * count:
+        elif len(data) - 12 != size * count:
             logging.error("{}Block size do not match".format(
                 " "*(index*2)))
             return vertices
 
-        ptr = 12
-        for i in range(count):
-            coords = BES.unpack("<fff", data[ptr:])
-            ptr += 12
-            normals = BES.unpack("<fff", data[ptr:])
-            ptr += 12
-
-            uv_array = []
-            for texID in range(texCnt):
-                uv = BES.unpack("<ff", data[ptr:])
-                uv_array.append(uv)
-                ptr += 8
-
-            vertices.append(BESVertex(coords, normals, uv_array))
-
-        return vertices
+        return frombuffer(data, BESVertex.dtype(flags), count, 12)
 
     def parse_block_faces(self, data, index):
         """
-        Parse Faces block and return list of tuples.
-        Each tuple means one face made of 3 integers (vertices IDs)
+        Parse Faces block and return array of faces (count x 3 uint32).
+        Each face is made of 3 vertices IDs
         """
+        from numpy import frombuffer, uint32
+
         (count,) = BES.unpack("<I", data)
-        faces = []
+        faces = frombuffer(b'', uint32).reshape(0, 3)
 
         logging.log(logging.VERBOSE, "{}Faces ({} B) - count: {}".format(
             " "*(index*2), len(data), count))
 
-        if len(data[4:]) != count * 12:
+        if len(data) - 4 != count * 12:
             logging.error("{}Block size do not match".format(
                 " "*(index*2)))
             return faces
 
-        ptr = 4
-        for i in range(count):
-            face = BES.unpack("<III", data[ptr:])
-            faces.append(face)
-            ptr += 12
-
-        return faces
+        return frombuffer(data, "<u4", count * 3, 4).reshape(count, 3)
 
     def parse_block_properties(self, data, index):
         (count, ) = BES.unpack("<I", data)
@@ -573,14 +697,14 @@ class BES(object):
 
         return (author, comment, faces)
 
-    def parse_block_material(self, data, index):
+    def parse_block_material(self, data, index, blockID):
         (children,) = BES.unpack("<I", data)
         logging.log(logging.VERBOSE, "{}Material ({} B) - Number of materials: {:08x}".format(
             " "*(index*2), len(data), children))
 
         res = self.parse_blocks({BES.BlockID.Standard : BES.BlockPresence.OptMultiple,
                     BES.BlockID.PteroMat  : BES.BlockPresence.OptMultiple},
-                    data[4:], index + 1)
+                    blockID, index + 1)
 
         if len(res[BES.BlockID.Standard]) + len(res[BES.BlockID.PteroMat]) != children:
             logging.error("{}Number of material children does not match".format(
@@ -24,9 +24,25 @@ cbf.py - util for unpacking CBF files and checking them for integrity
 import sys
 import argparse
 import struct
+import errno
 import os
+import hashlib
+import mmap
 import ntpath
+import fnmatch
 import logging
+import multiprocessing
+import threading
+import queue
+import contextlib
+import functools
+import collections
+import time
+import json
+import csv
+from array import array
+
+import cbfcipher
 
 __author__ = "Jan Havran"
 
@@ -122,77 +138,353 @@ class LZW(object):
 
         return bytes(data)
 
+class LZWDecoder(object):
+    """
+    Linear-time LZW decoder with the same semantics as LZW class.
+
+    Every dictionary row created while decoding is a previous output string
+    followed by one byte, so it is already stored in the output buffer as
+    a contiguous run. The decoder therefore keeps only length and output
+    position of each row (in compact arrays) and emits a code with a single
+    slice copy instead of walking its parent chain byte by byte.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def decompress(self):
+        dataLen = len(self.data)
+        stream = bytes(self.data) + b'\x00\x00\x00'
+        data = bytearray(0)
+
+        codeEnd = (1 << LZW.Default.dictWidth)
+        dictWidth = LZW.Default.dictWidth + 1
+        codeMax = (1 << dictWidth) - 1
+        dictLen = codeEnd + 1
+        rowPos = array('Q')
+        rowLen = array('Q')
+        fromBytes = int.from_bytes
+
+        dataPos = 0
+        prevPos = -1
+        prevLen = 0
+        while True:
+            dataPosB = dataPos >> 3
+            if dataPosB >= dataLen:
+                raise RuntimeError("    LZW: unexpected end of data")
+            keyCurr = (fromBytes(stream[dataPosB:dataPosB + 4], 'little') >> (dataPos & 7)) & codeMax
+            dataPos += dictWidth
+
+            if keyCurr == codeEnd:
+                break
+
+            currPos = len(data)
+            if prevPos >= 0:
+                if keyCurr > dictLen:
+                    raise RuntimeError("    LZW: invalid key")
+
+                rowPos.append(prevPos)
+                rowLen.append(prevLen + 1)
+                dictLen += 1
+                if dictLen >= codeMax:
+                    dictWidth += 1
+                    codeMax = (1 << dictWidth) - 1
+                    logging.debug("Dictionary key width extended to {} bits".format(dictWidth))
+                    if Stats.enabled:
+                        Stats.event("lzw-width", width=dictWidth, rows=dictLen, output=currPos)
+                    if dictWidth == 33:
+                        logging.error("LZW key width exceeded 32 bits")
+            elif keyCurr >= dictLen:
+                raise RuntimeError("    LZW: invalid key")
+
+            if keyCurr < codeEnd:
+                data.append(keyCurr)
+                prevLen = 1
+            else:
+                row = keyCurr - codeEnd - 1
+                pos = rowPos[row]
+                prevLen = rowLen[row]
+                if pos + prevLen > currPos:
+                    # KwKwK case - row was just created from the previous string
+                    data += data[pos:currPos]
+                    data.append(data[pos])
+                else:
+                    data += data[pos:pos + prevLen]
+            prevPos = currPos
+
+        return bytes(data)
+
+    def validate(self):
+        """
+        Decode keys without producing output and return length of decompressed
+        data. Widths and dictionary grow exactly as in decompress, only length
+        of each row is kept, so the same errors are detected
+        """
+        dataLen = len(self.data)
+        stream = bytes(self.data) + b'\x00\x00\x00'
+
+        codeEnd = (1 << LZW.Default.dictWidth)
+        dictWidth = LZW.Default.dictWidth + 1
+        codeMax = (1 << dictWidth) - 1
+        dictLen = codeEnd + 1
+        rowLen = array('Q')
+        fromBytes = int.from_bytes
+
+        dataPos = 0
+        outLen = 0
+        prevLen = 0
+        while True:
+            dataPosB = dataPos >> 3
+            if dataPosB >= dataLen:
+                raise RuntimeError("    LZW: unexpected end of data")
+            keyCurr = (fromBytes(stream[dataPosB:dataPosB + 4], 'little') >> (dataPos & 7)) & codeMax
+            dataPos += dictWidth
+
+            if keyCurr == codeEnd:
+                break
+
+            if prevLen:
+                if keyCurr > dictLen:
+                    raise RuntimeError("    LZW: invalid key")
+
+                rowLen.append(prevLen + 1)
+                dictLen += 1
+                if dictLen >= codeMax:
+                    dictWidth += 1
+                    codeMax = (1 << dictWidth) - 1
+                    logging.debug("Dictionary key width extended to {} bits".format(dictWidth))
+                    if Stats.enabled:
+                        Stats.event("lzw-width", width=dictWidth, rows=dictLen, output=outLen)
+                    if dictWidth == 33:
+                        logging.error("LZW key width exceeded 32 bits")
+            elif keyCurr >= dictLen:
+                raise RuntimeError("    LZW: invalid key")
+
+            if keyCurr < codeEnd:
+                prevLen = 1
+            else:
+                prevLen = rowLen[keyCurr - codeEnd - 1]
+            outLen += prevLen
+
+        return outLen
+
 class CBFFile(object):
-    def __init__(self, version, name, size, data, compressed):
+    def __init__(self, version, name, size, data, compressed, offset=0, dateTime=0):
         self.version = version
+        self.name = name
         self.basename = ntpath.basename(name)
         self.dirname  = ntpath.dirname(name).split("\\")
         self.size = size
         self.data = data
         self.compressed = compressed
+        self.offset = offset
+        self.dateTime = dateTime
 
-    def decompress(self):
+    def blocks(self):
+        """ Yield compressed data and decompressed size of each LZW block """
         dataPtr = 0
-        fileDecompressed = bytearray(0)
 
         while dataPtr + 12 < len(self.data):
-            (sig, blockCompressedSize, blockDecompressedSize) = unpack("<4sII", self.data[dataPtr:])
+            (sig, blockCompressedSize, blockDecompressedSize) = unpack("<4sII", self.data, dataPtr)
             dataPtr += 12
 
             if sig != LZW.Header.sig:
                 raise RuntimeError("    LZW: Invalid header signature")
 
-            if len(self.data[dataPtr:]) < blockCompressedSize:
+            if len(self.data) - dataPtr < blockCompressedSize:
                 raise RuntimeError("    LZW: not enough data in LZW block")
 
-            blockCompressed = self.data[dataPtr:dataPtr+blockCompressedSize]
-            lzw = LZW(blockCompressed)
-            blockDecompressed = lzw.decompress()
-
-            if len(blockDecompressed) != blockDecompressedSize:
-                logging.error("    LZW: Invalid size of decompressed LZW block")
-
-            fileDecompressed += blockDecompressed
+            yield (self.data[dataPtr:dataPtr+blockCompressedSize], blockDecompressedSize)
             dataPtr += blockCompressedSize
 
         if dataPtr != len(self.data):
             logging.error("    LZW: invalid size of compressed file")
 
-        return bytes(fileDecompressed)
+    def inflate(self):
+        """ Yield decompressed LZW blocks one by one """
+        for (blockCompressed, blockDecompressedSize) in self.blocks():
+            start = time.perf_counter() if Stats.enabled else 0
+            lzw = LZWDecoder(blockCompressed)
+            blockDecompressed = lzw.decompress()
+            if Stats.enabled:
+                Stats.add("inflate", len(blockDecompressed), time.perf_counter() - start)
 
-    def decrypt(self):
-        encryptedFile = self.data
-        fileLength = len(encryptedFile)
-        decryptedFile = bytearray(fileLength)
+            if len(blockDecompressed) != blockDecompressedSize:
+                logging.error("    LZW: Invalid size of decompressed LZW block")
 
-        key = fileLength & 0xFF
-        for pos in range(fileLength):
-            encryptedByte = encryptedFile[pos]
-            decryptedByte = ((encryptedByte + 0xA6 + key) & 0xFF) ^ key
-            decryptedFile[pos] = decryptedByte
+            yield blockDecompressed
 
-        return bytes(decryptedFile)
+    def decompress(self):
+        return b''.join(self.inflate())
 
-    def extractData(self):
-        extractedData = bytes()
+    def decrypt(self):
+        return cbfcipher.decrypt_file(self.data)
+
+    def extractChunks(self, chunkSize=0x100000):
+        """
+        Yield extracted content of this file piece by piece: one LZW block
+        at a time for compressed files, chunks of at most chunkSize bytes
+        for stored files (whole file if chunkSize is None)
+        """
+        dataLen = len(self.data)
+        if chunkSize is None:
+            chunkSize = max(dataLen, 1)
 
         if   self.compressed == 0 and self.version == CBFArchive.Version.ZBL0:
             logging.log(logging.VERBOSE, "  extracting: " + self.basename)
-            extractedData = self.data
+            for pos in range(0, dataLen, chunkSize):
+                yield self.data[pos:pos + chunkSize]
         elif self.compressed == 0 and self.version == CBFArchive.Version.ZBL1:
             logging.log(logging.VERBOSE, "  decrypting: " + self.basename)
-            extractedData = self.decrypt()
+            for pos in range(0, dataLen, chunkSize):
+                start = time.perf_counter() if Stats.enabled else 0
+                chunk = cbfcipher.decrypt_file(self.data[pos:pos + chunkSize], dataLen)
+                if Stats.enabled:
+                    Stats.add("decrypt", len(chunk), time.perf_counter() - start)
+                yield chunk
         elif self.compressed == 1:
             logging.log(logging.VERBOSE, "  inflating: " + self.basename)
-            extractedData = self.decompress()
+            yield from self.inflate()
+        else:
+            logging.error("    Skipping (Unknown compression method): " + self.basename)
+
+    def check(self):
+        """
+        Validate this file without extracting it (LZW blocks are only decoded
+        by LZWDecoder.validate, stored data need no decryption).
+        Return size of extracted file
+        """
+        if self.compressed == 1:
+            logging.log(logging.VERBOSE, "  checking: " + self.basename)
+            size = 0
+            for (blockCompressed, blockDecompressedSize) in self.blocks():
+                start = time.perf_counter() if Stats.enabled else 0
+                blockSize = LZWDecoder(blockCompressed).validate()
+                if Stats.enabled:
+                    Stats.add("inflate", blockSize, time.perf_counter() - start)
+
+                if blockSize != blockDecompressedSize:
+                    logging.error("    LZW: Invalid size of decompressed LZW block")
+                size += blockSize
+        elif self.compressed == 0:
+            logging.log(logging.VERBOSE, "  checking: " + self.basename)
+            size = len(self.data)
         else:
             logging.error("    Skipping (Unknown compression method): " + self.basename)
+            size = 0
+
+        if self.size != size:
+            logging.error("    Invalid size of extracted file")
+
+        return size
+
+    def isPassthrough(self):
+        """ Return True if stored data are the extracted content (stored file of ZBL0 archive) """
+        return self.compressed == 0 and self.version == CBFArchive.Version.ZBL0
+
+    def copyTo(self, fdWrite, fdRead):
+        """
+        Copy content of pass-through file from archive opened as fdRead into
+        fdWrite without user-space copies where possible (see copy_range),
+        remaining data (all if fdRead is None) are written from mapped archive
+        by chunks. Return size of extracted file
+        """
+        logging.log(logging.VERBOSE, "  extracting: " + self.basename)
+        dataLen = len(self.data)
+        copied = copy_range(fdRead, fdWrite, self.offset, dataLen) if fdRead is not None else 0
+        if copied < dataLen:
+            write_chunks(fdWrite, [self.data[pos:pos + 0x100000] for pos in range(copied, dataLen, 0x100000)])
+
+        if self.size != dataLen:
+            logging.error("    Invalid size of extracted file")
+
+        return dataLen
+
+    def extractData(self):
+        chunks = list(self.extractChunks(None))
+        # stored ZBL0 file is a view into mapped archive, always return bytes
+        extractedData = bytes(chunks[0]) if len(chunks) == 1 else b''.join(chunks)
 
         if self.size != len(extractedData):
             logging.error("    Invalid size of extracted file")
 
         return extractedData
 
+    def extractTo(self, fileWrite, digest=None):
+        """
+        Write extracted content into fileWrite (any object with write method,
+        or None to just check the file) as soon as each piece is decoded,
+        feed it into digest (hashlib object) if given.
+        Return size of extracted file
+        """
+        size = 0
+        for chunk in self.extractChunks():
+            if digest is not None:
+                digest.update(chunk)
+            if fileWrite is not None:
+                start = time.perf_counter() if Stats.enabled else 0
+                fileWrite.write(chunk)
+                if Stats.enabled:
+                    Stats.add("write", len(chunk), time.perf_counter() - start)
+            size += len(chunk)
+
+        if self.size != size:
+            logging.error("    Invalid size of extracted file")
+
+        return size
+
+    def read(self):
+        """ Return extracted content of this file (decrypted or inflated on demand) """
+        return self.extractData()
+
+class CBFTable(object):
+    """
+    Compact table of files of an archive.
+
+    Instead of CBFFile object per file, table keeps parallel arrays of
+    offsets, sizes, stored sizes, storage types and FILETIMEs and a single
+    blob of (windows-1250) names with array of their offsets. CBFFile of
+    a row is built on access, so the table behaves as a read-only list.
+    """
+    def __init__(self, version, data):
+        self.version = version
+        self.data = data
+        self.offsets = array('Q')
+        self.sizes = array('Q')
+        self.storedSizes = array('Q')
+        self.storageTypes = array('B')
+        self.dateTimes = array('Q')
+        self.nameOffsets = array('Q', [0])
+        self.nameBlob = bytearray()
+
+    def append(self, name, size, storedSize, storageType, offset, dateTime):
+        """ Add row, name is encoded in windows-1250 """
+        self.offsets.append(offset)
+        self.sizes.append(size)
+        self.storedSizes.append(storedSize)
+        self.storageTypes.append(storageType)
+        self.dateTimes.append(dateTime)
+        self.nameBlob += name
+        self.nameOffsets.append(len(self.nameBlob))
+
+    def name(self, index):
+        return str(self.nameBlob[self.nameOffsets[index]:self.nameOffsets[index + 1]], 'windows-1250')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.offsets)
+        offset = self.offsets[index]
+        return CBFFile(self.version, self.name(index), self.sizes[index],
+            self.data[offset:offset + self.storedSizes[index]], self.storageTypes[index],
+            offset, self.dateTimes[index])
+
+    def __iter__(self):
+        for index in range(len(self.offsets)):
+            yield self[index]
+
 class CBFArchive(object):
     class Header:
         size = 0x34
@@ -214,27 +506,101 @@ class CBFArchive(object):
         self.fileMode = CBFArchive.Mode.classic
         self.fileName = name
         self.fileData = data
+        self.comment = None
+        self.fileList = []
+        self.fileIndex = dict()
+        self.fileIdentity = None
+        self.dataCache = None
+        self.manifest = None
+        self.fileRead = None
+
+    @classmethod
+    def open(cls, fileName, cache=None, dataCache=None):
+        """
+        Open CBF archive for random access.
+        Only header and table of files are parsed (or loaded from CBFIndexCache
+        if given), files are extracted on demand by CBFFile.read
+        (and kept in CBFDataCache if given)
+        """
+        archive = cls(fileName, map_file(fileName))
+        archive.dataCache = dataCache
+        archive.load(cache)
+        return archive
+
+    @classmethod
+    def map(cls, fileName, name=None):
+        """
+        Map CBF archive for extraction. The mapped file is kept opened (see
+        fileno) until close, so pass-through files are copied from the same
+        file which was parsed, even if the archive is replaced meanwhile
+        """
+        fileRead = open(fileName, "rb")
+        try:
+            archive = cls(fileName if name is None else name, map_opened(fileRead))
+        except BaseException:
+            fileRead.close()
+            raise
+        archive.fileRead = fileRead
+        return archive
+
+    def identity(self):
+        """ Return key identifying content of this archive (path, size and mtime) """
+        if self.fileIdentity is None:
+            try:
+                st = os.stat(self.fileName)
+                self.fileIdentity = (os.path.abspath(self.fileName), st.st_size, st.st_mtime_ns)
+            except (OSError, TypeError, ValueError):
+                self.fileIdentity = (self.fileName, id(self))
+        return self.fileIdentity
+
+    def fileno(self):
+        """
+        Return file descriptor of archive file kept opened since it was
+        mapped (see map), None for archives without it (e.g. in memory)
+        """
+        if self.fileRead is None:
+            return None
+        return self.fileRead.fileno()
+
+    def close(self):
+        if self.fileRead is not None:
+            self.fileRead.close()
+            self.fileRead = None
+
+    def index_key(name):
+        """ Return key of file name in case-insensitive file index """
+        return name.replace("/", "\\").lower()
+
+    def get(self, name):
+        """ Return CBFFile of given (full path) name, raise KeyError if there is none """
+        return self.fileList[self.fileIndex[CBFArchive.index_key(name)]]
+
+    def read(self, name):
+        """ Return extracted content of file with given (full path) name """
+        file = self.get(name)
+        if self.dataCache is None:
+            return file.read()
+        return self.dataCache.read((self.identity(), file.offset), file.read)
+
+    def names(self):
+        """ Return full path names of all files in archive """
+        return [self.fileList.name(index) for index in range(len(self.fileList))]
 
     def decrypt(self, encryptedItem):
-        lookUpTable = [0x32, 0xF3, 0x1E, 0x06, 0x45, 0x70, 0x32, 0xAA, 0x55, 0x3F, 0xF1, 0xDE, 0xA3, 0x44, 0x21, 0xB4]
-        itemLength = len(encryptedItem)
-        decryptedItem = bytearray(itemLength)
-
-        key = itemLength
-        for pos in range(itemLength):
-            encryptedByte = encryptedItem[pos]
-            decryptedByte = encryptedByte ^ lookUpTable[key & 0xF]
-            key = encryptedByte
-            decryptedItem[pos] = decryptedByte
+        if not Stats.enabled:
+            return cbfcipher.decrypt_table(encryptedItem)
 
-        return bytes(decryptedItem)
+        start = time.perf_counter()
+        decryptedItem = cbfcipher.decrypt_table(encryptedItem)
+        Stats.add("table-decrypt", len(decryptedItem), time.perf_counter() - start)
+        return decryptedItem
 
     def parse_header(self):
         if len(self.fileData) < CBFArchive.Header.size:
             raise RuntimeError("  Invalid header size")
 
         (sig, ver, CBFSize, res1, fileCnt, tableOffset, res2, tableSize, res3) = unpack("<4s4sIIIIIII", self.fileData)
-        (headerSize, res4, lowDateTime, highDateTime) = unpack("<IIII", self.fileData[36:])
+        (headerSize, res4, lowDateTime, highDateTime) = unpack("<IIII", self.fileData, 36)
 
         if sig != CBFArchive.Header.sig:
             raise RuntimeError("  Invalid header signature")
@@ -264,15 +630,16 @@ class CBFArchive(object):
                 raise RuntimeError("  Invalid header size with extensions")
 
             if headerSize >= 64:
-                res5 = unpack("<III", self.fileData[52:])
+                res5 = unpack("<III", self.fileData, 52)
                 if res5[0] != 0 or res5[1] != 0 or res5[2] != 0:
                     logging.warning("  Non-zero reserved data in externsion header")
 
                 if headerSize >= 70:
-                    (label, commentSize) = unpack("<HI", self.fileData[64:])
-                    (comment,) = unpack("<" + str(commentSize) + "s", self.fileData[70:])
+                    (label, commentSize) = unpack("<HI", self.fileData, 64)
+                    (comment,) = unpack("<" + str(commentSize) + "s", self.fileData, 70)
                     comment = str(comment, 'windows-1250')
                     logging.debug("Comment: " + comment)
+                    self.comment = comment.strip(chr(0))
                 elif headerSize > 64:
                     logging.warning("  Invalid extension header size")
             else:
@@ -280,10 +647,10 @@ class CBFArchive(object):
 
         self.fileMode = CBFArchive.Mode.extended if headerSize > 0 else CBFArchive.Mode.classic
 
-        return (fileCnt, self.fileData[tableOffset:tableOffset + tableSize])
+        return (fileCnt, bytes(self.fileData[tableOffset:tableOffset + tableSize]))
 
     def parse_table(self, fileTable):
-        fileList = []
+        fileList = CBFTable(self.fileVer, self.fileData)
         pos = 0
         itemSize = CBFArchive.Table.itemSize
         descSize = 0 if self.fileVer == CBFArchive.Version.ZBL0 else 2
@@ -294,7 +661,7 @@ class CBFArchive(object):
                 break
 
             if self.fileVer == CBFArchive.Version.ZBL1:
-                (itemSize, ) = unpack("<H",fileTable[pos:])
+                (itemSize, ) = unpack("<H", fileTable, pos)
                 pos += descSize
 
             """
@@ -311,7 +678,7 @@ class CBFArchive(object):
             pos += itemSize
 
             (fileOffset, res1, unk1, lowDateTime, highDateTime) = unpack("<I4I", itemData)
-            (fileSize, res2, fileCompressedSize, fileStorageType, unk2) = unpack("<IIIII", itemData[20:])
+            (fileSize, res2, fileCompressedSize, fileStorageType, unk2) = unpack("<IIIII", itemData, 20)
 
             if res1 != 0 or res2 != 0:
                 logging.warning("  Non-zero reserved data in file desc")
@@ -321,19 +688,22 @@ class CBFArchive(object):
                     logging.warning("  Non-zero reserved data in classic file desc")
 
             if self.fileVer == CBFArchive.Version.ZBL0:
-                null_pos = fileTable[pos:].find(b'\x00')
-                if null_pos == -1:
+                null_pos = fileTable.find(b'\x00', pos) - pos
+                if null_pos < 0:
                     logging.error("  Corrupted item name in file table")
                     break
                 fileName = fileTable[pos:pos+null_pos + 1]
                 pos += null_pos + 1
             else:
-                (fileName, ) = unpack("<" + str(itemSize - CBFArchive.Table.itemSize) + "s", itemData[CBFArchive.Table.itemSize:])
+                (fileName, ) = unpack("<" + str(itemSize - CBFArchive.Table.itemSize) + "s", itemData, CBFArchive.Table.itemSize)
                 if fileName[-1] != 0x0:
                     logging.error("  Corrupted item name in file table")
                     break
 
-            fileName = str(fileName, 'windows-1250').strip(chr(0))
+            fileName = fileName.strip(b'\x00')
+            # names are kept encoded, decode only to fail on names not valid
+            # in windows-1250 (UnicodeDecodeError) here, as before
+            str(fileName, 'windows-1250')
 
             if fileStorageType == 0:
                 fileStoredSize = fileSize
@@ -349,51 +719,926 @@ class CBFArchive(object):
                 logging.error("  Invalid file data location")
                 continue
 
-            file = CBFFile(self.fileVer, fileName, fileSize, self.fileData[fileOffset:fileOffset + fileStoredSize], fileStorageType)
-            fileList.append(file)
+            fileList.append(fileName, fileSize, fileStoredSize, fileStorageType, fileOffset,
+                (highDateTime << 32) | lowDateTime)
 
         return fileList
 
+    def parse_file(self, file, extract):
+        if Stats.enabled:
+            Stats.begin_entry(file.name)
+
+        if extract:
+            fileDir = os.path.join(*file.dirname)
+            filePath = os.path.join(fileDir, file.basename)
+
+            if fileDir and not os.path.exists(fileDir):
+                start = time.perf_counter() if Stats.enabled else 0
+                os.makedirs(fileDir, exist_ok=True)
+                if Stats.enabled:
+                    Stats.add("mkdir", 0, time.perf_counter() - start)
+
+        size = 0
+        digest = Manifest.digest() if self.manifest is not None else None
+        try:
+            if extract and file.isPassthrough():
+                if digest is not None:
+                    digest.update(file.data)
+                start = time.perf_counter() if Stats.enabled else 0
+                with open(filePath, "wb") as fileWrite:
+                    size = file.copyTo(fileWrite.fileno(), self.fileno())
+                if Stats.enabled:
+                    Stats.add("copy", size, time.perf_counter() - start)
+            elif extract:
+                with open(filePath, "wb") as fileWrite:
+                    size = file.extractTo(fileWrite, digest)
+            elif digest is not None:
+                size = file.extractTo(None, digest)
+            else:
+                size = file.check()
+        finally:
+            if Stats.enabled:
+                Stats.end_entry(size)
+
+        if digest is not None:
+            return self.manifest.add(file, digest.hexdigest())
+        return None
+
     def parse_files(self, fileList, extract):
         for file in fileList:
-            if extract:
-                fileDir = os.path.join(*file.dirname)
-                filePath = os.path.join(fileDir, file.basename)
-
-                if fileDir and not os.path.exists(fileDir):
-                    os.makedirs(fileDir)
-
-            fileData = file.extractData()
-            if extract:
-                fileWrite = open(filePath, "wb")
-                fileWrite.write(fileData)
-                fileWrite.close()
-
-    def parse(self, extract):
-        (fileCnt, fileTable) = self.parse_header()
-        fileList = self.parse_table(fileTable)
-        if len(fileList) != fileCnt:
-            logging.error("Found {} files, but CBF should contain {} files".format(len(fileList), fileCnt))
-        self.parse_files(fileList, extract)
-
-def unpack(fmt, data):
+            self.parse_file(file, extract)
+
+    def parse_files_parallel(self, fileList, extract, jobs):
+        """
+        Extract files by pool of worker processes.
+        Workers map the archive on their own and receive only location
+        of each file, log messages are passed back and printed in order.
+        """
+        if extract:
+            for fileDir in set([os.path.join(*file.dirname) for file in fileList]):
+                if fileDir:
+                    os.makedirs(fileDir, exist_ok=True)
+
+        tasks = [(file.name, file.size, file.offset, len(file.data), file.compressed) for file in fileList]
+        chunkSize = max(1, min(64, len(tasks) // (jobs * 16)))
+        initArgs = (self.fileName, self.fileVer, logging.getLogger().getEffectiveLevel(), extract,
+            Stats.enabled, self.manifest is not None)
+
+        with multiprocessing.Pool(jobs, ExtractWorker.init, initArgs) as pool:
+            for (records, stats, entry) in pool.imap(ExtractWorker.run, tasks, chunkSize):
+                for (level, msg) in records:
+                    logging.log(level, msg)
+                if stats is not None:
+                    Stats.merge(stats)
+                if entry is not None:
+                    self.manifest.entries[CBFArchive.index_key(entry["name"])] = entry
+
+    def parse_files_pipelined(self, fileList, writers):
+        """
+        Extract files by decoding them in this thread and writing them by pool
+        of WRITERS threads, so decoding of next files overlaps with writing.
+        Directories are created up front, every file is written by single
+        writer (assigned in turn) and decoded blocks are passed to it one at
+        a time through small bounded queue, so only few blocks are in memory.
+        """
+        for fileDir in set([os.path.join(*file.dirname) for file in fileList]):
+            if fileDir:
+                os.makedirs(fileDir, exist_ok=True)
+
+        queues = [queue.Queue(4) for i in range(writers)]
+        writeTimes = []
+        fdRead = self.fileno()
+
+        def writer(tasks):
+            (fd, size, elapsed) = (None, 0, 0.0)
+            while True:
+                task = tasks.get()
+                if task is None:
+                    break
+                # ("open", file, path), ("write", file, chunk), ("close", file, None)
+                # or ("copy", file, path) for files copied directly from archive
+                (action, file, arg) = task
+                if action != "open" and action != "copy" and fd is None:
+                    continue # failed already
+                start = time.perf_counter()
+                try:
+                    if action == "open" or action == "copy":
+                        (fd, size, elapsed) = (None, 0, 0.0)
+                        fd = os.open(arg, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o666)
+                    if action == "copy":
+                        file.copyTo(fd, fdRead)
+                        size = file.size
+                    elif action == "write":
+                        write_chunks(fd, [arg])
+                        size += len(arg)
+                    if action == "copy" or action == "close":
+                        # close may report deferred errors (e.g. on network filesystems)
+                        (fdClose, fd) = (fd, None)
+                        os.close(fdClose)
+                        if Stats.enabled:
+                            writeTimes.append((size, elapsed + time.perf_counter() - start))
+                except Exception as e:
+                    # log and keep draining the queue until the end, so the decoding thread never blocks
+                    logging.error("  {}: {}".format(file.name, str(e).strip()))
+                    if fd is not None:
+                        with contextlib.suppress(OSError):
+                            os.close(fd)
+                        fd = None
+                    continue
+                elapsed += time.perf_counter() - start
+
+        threads = [threading.Thread(target=writer, args=(tasks,)) for tasks in queues]
+        for thread in threads:
+            thread.start()
+
+        def put(index, task):
+            """ Pass task to writer of given index, fail if the writer is not running any more """
+            while True:
+                try:
+                    queues[index].put(task, timeout=1.0)
+                    return
+                except queue.Full:
+                    if not threads[index].is_alive():
+                        raise RuntimeError("  Writer of extracted files terminated")
+
+        try:
+            for (index, file) in enumerate(fileList):
+                index %= writers
+                filePath = os.path.join(os.path.join(*file.dirname), file.basename)
+                if Stats.enabled:
+                    Stats.begin_entry(file.name)
+                digest = Manifest.digest() if self.manifest is not None else None
+                size = 0
+                if file.isPassthrough():
+                    # copied by writer directly from archive
+                    if digest is not None:
+                        digest.update(file.data)
+                    size = file.size
+                    if Stats.enabled:
+                        Stats.end_entry(size)
+                    put(index, ("copy", file, filePath))
+                else:
+                    put(index, ("open", file, filePath))
+                    try:
+                        for chunk in file.extractChunks():
+                            if digest is not None:
+                                digest.update(chunk)
+                            put(index, ("write", file, chunk))
+                            size += len(chunk)
+                    finally:
+                        put(index, ("close", file, None))
+                        if Stats.enabled:
+                            Stats.end_entry(size)
+
+                    if file.size != size:
+                        logging.error("    Invalid size of extracted file")
+                if digest is not None:
+                    self.manifest.add(file, digest.hexdigest())
+        finally:
+            for index in range(writers):
+                with contextlib.suppress(RuntimeError):
+                    put(index, None)
+            for thread in threads:
+                thread.join()
+
+        for (size, elapsed) in writeTimes:
+            Stats.add("write", size, elapsed)
+
+    def load(self, cache=None):
+        """ Parse header and table of files (unless cached) and build file index """
+        if cache is None or not cache.load(self):
+            (fileCnt, fileTable) = self.parse_header()
+            start = time.perf_counter() if Stats.enabled else 0
+            self.fileList = self.parse_table(fileTable)
+            if Stats.enabled:
+                Stats.add("table", len(fileTable), time.perf_counter() - start)
+            if len(self.fileList) != fileCnt:
+                logging.error("Found {} files, but CBF should contain {} files".format(len(self.fileList), fileCnt))
+            if cache is not None:
+                cache.store(self)
+
+        self.fileIndex = dict()
+        for index in range(len(self.fileList)):
+            name = self.fileList.name(index)
+            key = CBFArchive.index_key(name)
+            if key in self.fileIndex:
+                logging.warning("  Duplicate file name: " + name)
+            else:
+                self.fileIndex[key] = index
+
+    def select(self, include=None, exclude=None):
+        """
+        Return files whose names match any of include glob patterns (or all
+        files if there are none) and none of exclude patterns. Matching is
+        case-insensitive and slash may be used instead of backslash
+        """
+        include = [CBFArchive.index_key(pattern) for pattern in include or []]
+        exclude = [CBFArchive.index_key(pattern) for pattern in exclude or []]
+        fileList = []
+        for index in range(len(self.fileList)):
+            key = CBFArchive.index_key(self.fileList.name(index))
+            if include and not any([fnmatch.fnmatchcase(key, pattern) for pattern in include]):
+                continue
+            if any([fnmatch.fnmatchcase(key, pattern) for pattern in exclude]):
+                continue
+            fileList.append(self.fileList[index])
+        return fileList
+
+    def parse(self, extract, jobs=1, writers=0, include=None, exclude=None):
+        self.load()
+        fileList = self.select(include, exclude) if include or exclude else self.fileList
+        try:
+            if jobs > 1:
+                self.parse_files_parallel(fileList, extract, jobs)
+            elif extract and writers > 0:
+                self.parse_files_pipelined(fileList, writers)
+            else:
+                self.parse_files(fileList, extract)
+        finally:
+            self.close()
+
+class Stats(object):
+    """
+    Opt-in instrumentation of CBF processing.
+
+    When enabled, monotonic timers and byte counters are collected for every
+    stage (map, table, table-decrypt, decrypt, inflate, mkdir, write), for
+    every extracted file and LZW key width extensions are recorded as events.
+    Hooks (callables taking kind and dictionary of data) are notified about
+    every stage measurement ("stage"), finished file ("entry") and event
+    ("event"). When disabled, every instrumented place costs single
+    attribute check.
+    """
+    enabled = False
+    stages = dict()
+    entries = []
+    events = []
+    entry = None
+    hooks = []
+
+    def enable(hook=None):
+        Stats.enabled = True
+        if hook is not None:
+            Stats.hooks.append(hook)
+
+    def disable():
+        Stats.enabled = False
+
+    def reset():
+        Stats.stages = dict()
+        Stats.entries = []
+        Stats.events = []
+        Stats.entry = None
+
+    def notify(kind, data):
+        for hook in Stats.hooks:
+            hook(kind, data)
+
+    def add(stage, size, elapsed):
+        """ Account size bytes and elapsed seconds to stage (and current file) """
+        counter = Stats.stages.setdefault(stage, {"calls": 0, "bytes": 0, "seconds": 0.0})
+        counter["calls"] += 1
+        counter["bytes"] += size
+        counter["seconds"] += elapsed
+
+        if Stats.entry is not None:
+            counter = Stats.entry["stages"].setdefault(stage, {"bytes": 0, "seconds": 0.0})
+            counter["bytes"] += size
+            counter["seconds"] += elapsed
+
+        if Stats.hooks:
+            Stats.notify("stage", {"stage": stage, "bytes": size, "seconds": elapsed})
+
+    def event(name, **data):
+        data["event"] = name
+        if Stats.entry is not None:
+            data["entry"] = Stats.entry["name"]
+        Stats.events.append(data)
+        if Stats.hooks:
+            Stats.notify("event", data)
+
+    def begin_entry(name):
+        Stats.entry = {"name": name, "bytes": 0, "seconds": 0.0, "stages": dict(),
+            "start": time.perf_counter()}
+
+    def end_entry(size):
+        entry = Stats.entry
+        Stats.entry = None
+        entry["bytes"] = size
+        entry["seconds"] = time.perf_counter() - entry.pop("start")
+        Stats.entries.append(entry)
+        if Stats.hooks:
+            Stats.notify("entry", entry)
+
+    def take():
+        """ Return collected data and start over """
+        data = {"stages": Stats.stages, "entries": Stats.entries, "events": Stats.events}
+        Stats.reset()
+        return data
+
+    def merge(data):
+        """ Add data collected by another process (see take) """
+        for (stage, counter) in data["stages"].items():
+            total = Stats.stages.setdefault(stage, {"calls": 0, "bytes": 0, "seconds": 0.0})
+            for key in total:
+                total[key] += counter[key]
+        Stats.entries.extend(data["entries"])
+        Stats.events.extend(data["events"])
+
+    def dump():
+        return {"stages": Stats.stages, "entries": Stats.entries, "events": Stats.events}
+
+    def text():
+        """ Return stage summary as text """
+        lines = []
+        for (stage, counter) in sorted(Stats.stages.items()):
+            rate = counter["bytes"] / counter["seconds"] / 1e6 if counter["seconds"] > 0 else 0.0
+            lines.append("{:<14} {:>8} calls {:>12} B {:>10.3f} s {:>10.2f} MB/s".format(
+                stage, counter["calls"], counter["bytes"], counter["seconds"], rate))
+        lines.append("{:<14} {:>8} files {:>12} B".format("entries", len(Stats.entries),
+            sum([entry["bytes"] for entry in Stats.entries])))
+        return "\n".join(lines)
+
+class LogRecorder(logging.Handler):
+    """ Logging handler storing (level, message) of every record """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+    def take(self):
+        """ Return stored records and start over """
+        records = self.records
+        self.records = []
+        return records
+
+class ExtractWorker(object):
+    """ State of worker process used by CBFArchive.parse_files_parallel """
+    archive = None
+    extract = False
+    recorder = None
+
+    def init(fileName, fileVer, level, extract, stats, manifest):
+        Stats.enabled = stats
+        Stats.hooks = []
+        Stats.reset()
+        ExtractWorker.archive = CBFArchive.map(fileName)
+        ExtractWorker.archive.fileVer = fileVer
+        ExtractWorker.archive.manifest = Manifest(fileName) if manifest else None
+        ExtractWorker.extract = extract
+        ExtractWorker.recorder = LogRecorder()
+
+        logger = logging.getLogger()
+        logger.handlers = [ExtractWorker.recorder]
+        logger.setLevel(level)
+
+    def run(task):
+        """
+        Extract single file and return list of logged (level, message),
+        collected Stats and Manifest entry (if enabled)
+        """
+        (fileName, fileSize, fileOffset, fileStoredSize, fileStorageType) = task
+        archive = ExtractWorker.archive
+
+        file = CBFFile(archive.fileVer, fileName, fileSize,
+            archive.fileData[fileOffset:fileOffset + fileStoredSize], fileStorageType, fileOffset)
+        entry = None
+        try:
+            entry = archive.parse_file(file, ExtractWorker.extract)
+        except (OSError, RuntimeError) as e:
+            logging.error("  {}: {}".format(fileName, str(e).strip()))
+
+        return (ExtractWorker.recorder.take(), Stats.take() if Stats.enabled else None, entry)
+
+class CBFDataCache(object):
+    """
+    LRU cache of extracted files limited by total size of stored data.
+    Entries are keyed by (archive identity, file offset), see CBFArchive.read.
+    """
+
+    def __init__(self, budget, threadSafe=False):
+        self.budget = budget
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock() if threadSafe else contextlib.nullcontext()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Return cached data or None """
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        """ Store data, evict least recently used entries over budget """
+        if len(data) > self.budget:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = data
+            self.size += len(data)
+
+            while self.size > self.budget:
+                (oldKey, oldData) = self.entries.popitem(last=False)
+                self.size -= len(oldData)
+                self.evictions += 1
+
+    def read(self, key, extract):
+        """ Return cached data, or call extract and store its result """
+        data = self.get(key)
+        if data is None:
+            data = extract()
+            self.put(key, data)
+        return data
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """ Return dictionary of cache counters """
+        with self.lock:
+            return {"entries": len(self.entries), "size": self.size, "budget": self.budget,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+class CBFIndexCache(object):
+    """
+    Persistent cache of parsed tables of files.
+
+    Every archive has its own cache file (named by hash of its absolute path)
+    in cache directory. Cache file is valid for archive with the same path,
+    size, modification time and header and is loaded by a single read.
+
+    Cache file layout (little endian):
+      * header: signature, version, archive size, mtime (ns), header hash,
+        CBF version, CBF mode, number of files, size of path and names,
+      * archive path (UTF-8),
+      * fixed size record for every file (see Record),
+      * file names (windows-1250) separated by NULL character.
+    """
+
+    class Header:
+        sig = b'CBFI'
+        ver = 1
+        fmt = "<4sIQQ16s4sIIII"
+
+    class Record:
+        # offset, size, stored size, storage type, FILETIME
+        fmt = "<IIIIQ"
+
+    def __init__(self, cacheDir=None):
+        if cacheDir is None:
+            cacheDir = os.environ.get("CBF_INDEX_CACHE")
+        if cacheDir is None:
+            cacheBase = os.environ.get("XDG_CACHE_HOME", os.path.expanduser(os.path.join("~", ".cache")))
+            cacheDir = os.path.join(cacheBase, "vc-spec", "cbf")
+        self.cacheDir = cacheDir
+
+    def path(self, fileName):
+        """ Return path of cache file for given archive """
+        key = hashlib.blake2b(os.path.abspath(fileName).encode("utf-8"), digest_size=16).hexdigest()
+        return os.path.join(self.cacheDir, key + ".idx")
+
+    def identity(self, archive):
+        """ Return (path, size, mtime, header hash) identifying archive content """
+        st = os.stat(archive.fileName)
+        headerHash = hashlib.blake2b(archive.fileData[:CBFArchive.Header.size], digest_size=16).digest()
+        return (os.path.abspath(archive.fileName).encode("utf-8"), st.st_size, st.st_mtime_ns, headerHash)
+
+    def load(self, archive):
+        """ Fill file list of archive from cache, return False if cache is missing or stale """
+        try:
+            with open(self.path(archive.fileName), "rb") as f:
+                data = f.read()
+            (path, size, mtime, headerHash) = self.identity(archive)
+        except OSError:
+            return False
+
+        headerSize = struct.calcsize(CBFIndexCache.Header.fmt)
+        recordSize = struct.calcsize(CBFIndexCache.Record.fmt)
+        if len(data) < headerSize:
+            return False
+
+        (sig, ver, cachedSize, cachedMtime, cachedHash, fileVer, fileMode,
+            fileCnt, pathSize, namesSize) = unpack(CBFIndexCache.Header.fmt, data)
+        if (sig != CBFIndexCache.Header.sig or ver != CBFIndexCache.Header.ver or
+            headerSize + pathSize + fileCnt * recordSize + namesSize != len(data)):
+            return False
+
+        pos = headerSize
+        if (data[pos:pos + pathSize] != path or cachedSize != size or
+            cachedMtime != mtime or cachedHash != headerHash):
+            return False
+        pos += pathSize
+
+        records = struct.iter_unpack(CBFIndexCache.Record.fmt, data[pos:pos + fileCnt * recordSize])
+        pos += fileCnt * recordSize
+        names = data[pos:].split(b'\x00') if fileCnt else []
+
+        fileList = CBFTable(fileVer, archive.fileData)
+        for ((fileOffset, fileSize, fileStoredSize, fileStorageType, dateTime), fileName) in zip(records, names):
+            fileList.append(fileName, fileSize, fileStoredSize, fileStorageType, fileOffset, dateTime)
+
+        archive.fileVer = fileVer
+        archive.fileMode = fileMode
+        archive.fileList = fileList
+        return True
+
+    def store(self, archive):
+        """ Write file list of archive to cache (failures are not fatal) """
+        try:
+            (path, size, mtime, headerHash) = self.identity(archive)
+            table = archive.fileList
+            names = chr(0).join(archive.names()).encode('windows-1250')
+            records = b''.join([struct.pack(CBFIndexCache.Record.fmt, table.offsets[index], table.sizes[index],
+                table.storedSizes[index], table.storageTypes[index], table.dateTimes[index])
+                for index in range(len(table))])
+            header = struct.pack(CBFIndexCache.Header.fmt, CBFIndexCache.Header.sig,
+                CBFIndexCache.Header.ver, size, mtime, headerHash, archive.fileVer,
+                archive.fileMode, len(archive.fileList), len(path), len(names))
+
+            os.makedirs(self.cacheDir, exist_ok=True)
+            cachePath = self.path(archive.fileName)
+            with open(cachePath + ".tmp", "wb") as f:
+                f.write(header + path + records + names)
+            os.replace(cachePath + ".tmp", cachePath)
+        except (OSError, UnicodeError) as e:
+            logging.warning("  Unable to store index cache: {}".format(e))
+
+def unpack(fmt, data, offset=0):
         st_fmt = fmt
-        st_len = struct.calcsize(st_fmt)
         st_unpack = struct.Struct(st_fmt).unpack_from
 
-        return st_unpack(data[:st_len])
+        return st_unpack(data, offset)
+
+def filetime(timestamp):
+    """ Convert UNIX timestamp in ns into FILETIME (100 ns intervals since 1601) """
+    return timestamp // 100 + 116444736000000000
+
+def timestamp(dateTime):
+    """ Convert FILETIME into UNIX timestamp in ns """
+    return (dateTime - 116444736000000000) * 100
+
+def map_file(fileName):
+    """
+    Map whole file into memory and return read-only memoryview of it.
+    Pages are loaded on first access and the mapping is released together
+    with the last view referencing it.
+    """
+    with open(fileName, "rb") as f:
+        return map_opened(f)
+
+def map_opened(fileRead):
+    """ Map whole opened file into memory and return read-only memoryview of it (see map_file) """
+    if os.fstat(fileRead.fileno()).st_size == 0:
+        return memoryview(b'')
+    return memoryview(mmap.mmap(fileRead.fileno(), 0, access=mmap.ACCESS_READ))
+
+def copy_range(fdRead, fdWrite, offset, size):
+    """
+    Copy size bytes at offset of fdRead to current position of fdWrite inside
+    kernel (by copy_file_range or sendfile, where supported). Return number
+    of copied bytes, caller is expected to copy the rest on its own
+    """
+    copied = 0
+    for method in ["copy_file_range", "sendfile"]:
+        if not hasattr(os, method):
+            continue
+        try:
+            while copied < size:
+                count = min(size - copied, 0x40000000)
+                if method == "copy_file_range":
+                    count = os.copy_file_range(fdRead, fdWrite, count, offset + copied)
+                else:
+                    count = os.sendfile(fdWrite, fdRead, offset + copied, count)
+                if count == 0:
+                    break
+                copied += count
+            return copied
+        except OSError as e:
+            # not supported between these files, try next method
+            if e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF]:
+                raise
+    return copied
+
+def write_chunks(fd, chunks):
+    """ Write all chunks into file descriptor fd (by single writev call where available) """
+    views = [memoryview(chunk) for chunk in chunks if len(chunk)]
+    pos = 0
+    while pos < len(views):
+        if hasattr(os, "writev"):
+            written = os.writev(fd, views[pos:pos + 1024])
+        else:
+            written = os.write(fd, views[pos])
 
-def processFile(fileName, extract):
+        # skip written chunks, continue with rest of partially written one
+        while written > 0:
+            if written >= len(views[pos]):
+                written -= len(views[pos])
+                pos += 1
+            else:
+                views[pos] = views[pos][written:]
+                written = 0
+
+def processFile(fileName, extract, jobs=1, manifestName=None, writers=0, include=None, exclude=None):
     logging.info("Archive: " + fileName)
     try:
-        data = open(fileName, "rb").read()
-        cbf = CBFArchive(fileName, data)
-        cbf.parse(extract)
+        start = time.perf_counter() if Stats.enabled else 0
+        cbf = CBFArchive.map(fileName)
+        if Stats.enabled:
+            Stats.add("map", len(cbf.fileData), time.perf_counter() - start)
+        if manifestName is not None:
+            cbf.manifest = Manifest(fileName)
+        cbf.parse(extract, jobs, writers, include, exclude)
+        if manifestName is not None:
+            cbf.manifest.store(manifestName)
     except FileNotFoundError as e:
         logging.error(e)
     except RuntimeError as e:
         logging.error(e)
 
+def listFiles(fileNames, asJson=False, include=None, exclude=None):
+    """
+    Print files of archives (only headers and tables are parsed) as text
+    or JSON, return False if any archive could not be read
+    """
+    listing = []
+    success = True
+    for fileName in fileNames:
+        try:
+            archive = CBFArchive.open(fileName)
+        except (OSError, RuntimeError, struct.error, ValueError) as e:
+            # malformed header or table (struct.error) or undecodable name (ValueError)
+            logging.error("{}: {}".format(fileName, str(e).strip()))
+            success = False
+            continue
+
+        entries = [{"name": file.name, "size": file.size, "storedSize": len(file.data),
+            "storage": file.compressed, "dateTime": file.dateTime}
+            for file in archive.select(include, exclude)]
+        if asJson:
+            listing.append({"archive": fileName, "entries": entries})
+            continue
+
+        logging.info("Archive: " + fileName)
+        for entry in entries:
+            # classic archives have no time of files
+            dateTime = "-" if entry["dateTime"] == 0 else \
+                time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(timestamp(entry["dateTime"]) // 1000000000))
+            print("{:>12} {:>12} {} {:<19} {}".format(entry["size"], entry["storedSize"],
+                ["stored", "lzw   "][entry["storage"]], dateTime, entry["name"]))
+
+    if asJson:
+        json.dump(listing, sys.stdout, indent=1)
+        print()
+    return success
+
+class Manifest(object):
+    """
+    BLAKE2 hashes of files of an archive.
+
+    For every file hash of stored (possibly compressed or encrypted) bytes
+    and hash of extracted content are kept, the latter is computed while
+    the file is being extracted. Manifest is stored as JSON.
+    """
+    digestSize = 16
+
+    def __init__(self, archive=""):
+        self.archive = archive
+        self.entries = dict()
+
+    def digest():
+        return hashlib.blake2b(digest_size=Manifest.digestSize)
+
+    def hash(data):
+        digest = Manifest.digest()
+        digest.update(data)
+        return digest.hexdigest()
+
+    def add(self, file, content):
+        """ Add file with hex digest of its extracted content, return the new entry """
+        entry = {"name": file.name, "size": file.size, "storage": file.compressed,
+            "stored": Manifest.hash(file.data), "content": content}
+        self.entries[CBFArchive.index_key(file.name)] = entry
+        return entry
+
+    def get(self, name):
+        return self.entries.get(CBFArchive.index_key(name))
+
+    def load(fileName):
+        with open(fileName, "r") as f:
+            data = json.load(f)
+        manifest = Manifest(data["archive"])
+        for entry in data["entries"]:
+            manifest.entries[CBFArchive.index_key(entry["name"])] = entry
+        return manifest
+
+    def store(self, fileName):
+        with open(fileName, "w") as f:
+            json.dump({"archive": self.archive, "digest": "blake2b-{}".format(Manifest.digestSize * 8),
+                "entries": list(self.entries.values())}, f, indent=1)
+
+def verifyManifest(fileName, manifestName):
+    """
+    Compare archive against manifest and log files which were added, removed
+    or changed. Only files whose stored bytes differ are extracted (to tell
+    changed content from just repacked file). Return number of differences
+    """
+    logging.info("Archive: {} (manifest {})".format(fileName, manifestName))
+    manifest = Manifest.load(manifestName)
+    archive = CBFArchive(fileName, map_file(fileName))
+    archive.load()
+
+    differences = 0
+    for file in archive.fileList:
+        entry = manifest.get(file.name)
+        if entry is None:
+            logging.info("  added: " + file.name)
+            differences += 1
+            continue
+        if entry["size"] == file.size and entry["stored"] == Manifest.hash(file.data):
+            logging.log(logging.VERBOSE, "  unchanged: " + file.name)
+            continue
+
+        digest = Manifest.digest()
+        try:
+            file.extractTo(None, digest)
+        except RuntimeError as e:
+            logging.error("  {}: {}".format(file.name, str(e).strip()))
+        if entry["size"] == file.size and entry["content"] == digest.hexdigest():
+            logging.log(logging.VERBOSE, "  repacked: " + file.name)
+        else:
+            logging.info("  changed: " + file.name)
+            differences += 1
+
+    for entry in manifest.entries.values():
+        if CBFArchive.index_key(entry["name"]) not in archive.fileIndex:
+            logging.info("  removed: " + entry["name"])
+            differences += 1
+
+    return differences
+
+class CheckStatus:
+    ok = "ok"
+    warning = "warning"
+    error = "error"
+
+    def of(records):
+        """ Return status matching the most severe of logged records """
+        level = max([record[0] for record in records], default=logging.NOTSET)
+        if level >= logging.ERROR:
+            return CheckStatus.error
+        if level >= logging.WARNING:
+            return CheckStatus.warning
+        return CheckStatus.ok
+
+    # stable codes of problems, first matching part of message wins
+    codes = [
+        ("LZW: invalid key", "invalid-key"),
+        ("LZW key width exceeded", "key-width"),
+        ("LZW: unexpected end of data", "unexpected-end"),
+        ("LZW: Invalid header signature", "bad-signature"),
+        ("LZW: not enough data", "short-block"),
+        ("LZW: invalid size of compressed file", "trailing-data"),
+        ("LZW: Invalid size of decompressed", "block-size-mismatch"),
+        ("Invalid size of extracted file", "size-mismatch"),
+        ("Unknown compression method", "unknown-storage"),
+        ("Unknown storage type", "unknown-storage"),
+        ("Invalid header", "bad-header"),
+        ("Invalid extension header", "bad-header"),
+        ("Unknown CBF version", "bad-version"),
+        ("Invalid CBF size", "bad-size"),
+        ("Invalid file table location", "bad-table"),
+        ("Corrupted item", "bad-table"),
+        ("Unknown data after file table", "unknown-data"),
+        ("Non-zero reserved data", "reserved-data"),
+        ("Compressed size should be zero", "bad-stored-size"),
+        ("Invalid file data location", "bad-location"),
+        ("files, but CBF should contain", "file-count"),
+        ("Duplicate file name", "duplicate-name"),
+        ("[Errno", "io-error"),
+    ]
+
+    def code(records):
+        """ Return code of the first of the most severe logged records ("" if there is none) """
+        level = max([record[0] for record in records], default=logging.NOTSET)
+        if level < logging.WARNING:
+            return ""
+        msg = [msg for (msgLevel, msg) in records if msgLevel == level][0]
+        for (part, code) in CheckStatus.codes:
+            if part in msg:
+                return code
+        return "other"
+
+def checkFile(fileName, include=None, exclude=None):
+    """
+    Check archive (only files selected by include and exclude patterns, see
+    CBFArchive.select) and return its results as dictionary with archive
+    status, messages, counters and list of results for every file.
+    Log messages are recorded in the results instead of being printed.
+    """
+    recorder = LogRecorder()
+    logger = logging.getLogger()
+    handlers = logger.handlers
+    logger.handlers = [recorder]
+
+    result = {"archive": fileName, "status": CheckStatus.ok, "code": "", "messages": [],
+        "files": 0, "bytes": 0, "time": 0.0, "entries": []}
+    start = time.perf_counter()
+    try:
+        try:
+            archive = CBFArchive(fileName, map_file(fileName))
+            archive.load()
+        except Exception as e:
+            logging.error("  {}".format(str(e).strip()))
+            archive = None
+
+        records = recorder.take()
+        if archive is not None:
+            fileList = archive.select(include, exclude) if include or exclude else archive.fileList
+            for file in fileList:
+                entryStart = time.perf_counter()
+                size = 0
+                try:
+                    size = file.check()
+                except Exception as e:
+                    logging.error("    {}".format(str(e).strip()))
+                entryRecords = recorder.take()
+
+                result["entries"].append({"name": file.name,
+                    "status": CheckStatus.of(entryRecords),
+                    "code": CheckStatus.code(entryRecords),
+                    "messages": [msg.strip() for (level, msg) in entryRecords if level >= logging.WARNING],
+                    "storage": file.compressed, "size": file.size, "bytes": size,
+                    "time": time.perf_counter() - entryStart})
+                records.extend(entryRecords)
+                result["bytes"] += size
+            result["files"] = len(fileList)
+    finally:
+        logger.handlers = handlers
+
+    result["time"] = time.perf_counter() - start
+    result["status"] = CheckStatus.of(records)
+    result["code"] = CheckStatus.code(records)
+    result["messages"] = [msg.strip() for (level, msg) in records if level >= logging.WARNING]
+    result["records"] = records
+    return result
+
+def checkFiles(fileNames, jobs=1, include=None, exclude=None):
+    """
+    Check archives (by pool of JOBS worker processes) and print their messages
+    in order, return list of results (see checkFile)
+    """
+    check = functools.partial(checkFile, include=include, exclude=exclude)
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(check, fileNames)
+    else:
+        pool = None
+        results = map(check, fileNames)
+
+    resultList = []
+    for result in results:
+        logging.info("Archive: {} - {}".format(result["archive"], result["status"]))
+        for (level, msg) in result.pop("records"):
+            logging.log(level, msg)
+        resultList.append(result)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    return resultList
+
+def writeReport(results, reportName):
+    """ Write results of checkFiles into CSV (by extension) or JSON file """
+    if reportName.lower().endswith(".csv"):
+        with open(reportName, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["archive", "name", "status", "code", "storage", "size", "bytes", "time", "messages"])
+            for result in results:
+                writer.writerow([result["archive"], "", result["status"], result["code"], "", "",
+                    result["bytes"], "{:.6f}".format(result["time"]), "; ".join(result["messages"])])
+                for entry in result["entries"]:
+                    writer.writerow([result["archive"], entry["name"], entry["status"], entry["code"],
+                        entry["storage"], entry["size"], entry["bytes"],
+                        "{:.6f}".format(entry["time"]), "; ".join(entry["messages"])])
+    else:
+        with open(reportName, "w") as f:
+            json.dump(results, f, indent=1)
+
 if __name__ == "__main__":
     level = logging.INFO
 
@@ -404,6 +1649,34 @@ if __name__ == "__main__":
     parser.add_argument("-x", "--extract",
         help="extract files from an EXTRACT archive",
         nargs="?")
+    parser.add_argument("-l", "--list",
+        help="list files of LIST archives (name, sizes, storage type and time)",
+        nargs="+")
+    parser.add_argument("--json",
+        help="print list of files as JSON",
+        action="store_true")
+    parser.add_argument("-i", "--include",
+        help="process only files matching INCLUDE glob pattern (may be repeated)",
+        action="append")
+    parser.add_argument("-e", "--exclude",
+        help="skip files matching EXCLUDE glob pattern (may be repeated)",
+        action="append")
+    parser.add_argument("-j", "--jobs",
+        help="extract files by JOBS worker processes",
+        type=int, default=1)
+    parser.add_argument("-w", "--writers",
+        help="write extracted files by WRITERS threads while next files are decoded (0 - disabled)",
+        type=int, default=4)
+    parser.add_argument("-r", "--report",
+        help="check archives in batch mode and write results into REPORT (JSON or CSV by extension)")
+    parser.add_argument("-m", "--manifest",
+        help="write BLAKE2 hashes of checked or extracted files into MANIFEST")
+    parser.add_argument("--verify",
+        help="compare ARCHIVE against MANIFEST, extract only files whose stored data differ",
+        nargs=2, metavar=("MANIFEST", "ARCHIVE"))
+    parser.add_argument("-s", "--stats",
+        help="print timers and counters of processing stages to stdout",
+        choices=["text", "json"])
     parser.add_argument("-v", "--verbose",
         help="verbose mode ON",
         action="store_true")
@@ -415,14 +1688,47 @@ if __name__ == "__main__":
 
     logging.basicConfig(level=level, format="%(message)s")
 
-    if not (args.check or args.extract):
+    if not (args.check or args.extract or args.verify or args.list):
         parser.print_help()
         sys.exit(1)
 
-    if args.check:
+    if args.check and args.manifest and (args.report or args.jobs > 1 or len(args.check) > 1):
+        parser.error("-m/--manifest can be written only for single archive checked without -r/--report and -j/--jobs")
+
+    status = 0
+    if args.stats:
+        Stats.enable()
+
+    if args.list:
+        if not listFiles(args.list, args.json, args.include, args.exclude):
+            status = 1
+
+    if args.check and (args.report or args.jobs > 1):
+        results = checkFiles(args.check, args.jobs, args.include, args.exclude)
+        if args.report:
+            writeReport(results, args.report)
+        if any([result["status"] == CheckStatus.error for result in results]):
+            status = 1
+    elif args.check:
         for fileName in args.check:
-            processFile(fileName, False)
+            processFile(fileName, False, args.jobs, args.manifest, 0, args.include, args.exclude)
 
     if args.extract:
-        processFile(args.extract, True)
+        processFile(args.extract, True, args.jobs, args.manifest, args.writers, args.include, args.exclude)
+
+    if args.verify:
+        try:
+            if verifyManifest(args.verify[1], args.verify[0]):
+                status = 1
+        except (OSError, ValueError, KeyError, RuntimeError) as e:
+            logging.error(e)
+            status = 2
+
+    if args.stats == "json":
+        json.dump(Stats.dump(), sys.stdout, indent=1)
+        print()
+    elif args.stats == "text":
+        print(Stats.text())
+
+    sys.exit(status)
 
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  version 2 as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""
+cbfbench.py - benchmarks of CBF processing stages
+"""
+
+import sys
+import argparse
+import os
+import time
+import random
+import tempfile
+import tracemalloc
+import platform
+import json
+import logging
+
+import cbf
+import cbfcipher
+import cbfpack
+
+__author__ = "Jan Havran"
+
+def collect_blocks(fileNames):
+    """
+    Return list of (compressed data, decompressed size) tuples
+    for every LZW block of every compressed file in given archives
+    """
+    blocks = []
+
+    for fileName in fileNames:
+        archive = cbf.CBFArchive(fileName, cbf.map_file(fileName))
+        (fileCnt, fileTable) = archive.parse_header()
+        for file in archive.parse_table(fileTable):
+            if file.compressed == 1:
+                blocks.extend(file.blocks())
+
+    return blocks
+
+def bench_decoder(decoder, blocks):
+    """ Decode all blocks and return number of produced bytes and elapsed time """
+    size = 0
+
+    start = time.perf_counter()
+    for (blockCompressed, blockDecompressedSize) in blocks:
+        size += len(decoder(blockCompressed).decompress())
+    elapsed = time.perf_counter() - start
+
+    return (size, elapsed)
+
+def report(name, size, elapsed):
+    rate = size / elapsed if elapsed > 0 else float("inf")
+    logging.info("{:<14} {:>12} B {:>10.3f} s {:>14.0f} B/s".format(name, size, elapsed, rate))
+
+def bench_lzw(args):
+    blocks = collect_blocks(args.archive)
+    if args.limit:
+        blocks = [block for block in blocks if block[1] <= args.limit]
+    logging.info("LZW blocks: {}".format(len(blocks)))
+
+    decoders = [("LZWDecoder", cbf.LZWDecoder)]
+    if not args.skip_old:
+        decoders.append(("LZW", cbf.LZW))
+
+    for (name, decoder) in decoders:
+        (size, elapsed) = bench_decoder(decoder, blocks)
+        report(name, size, elapsed)
+
+def decrypt_file_bytewise(encryptedFile):
+    """ Original per-byte file decryption (reference for benchmark) """
+    fileLength = len(encryptedFile)
+    decryptedFile = bytearray(fileLength)
+
+    key = fileLength & 0xFF
+    for pos in range(fileLength):
+        decryptedFile[pos] = ((encryptedFile[pos] + 0xA6 + key) & 0xFF) ^ key
+
+    return bytes(decryptedFile)
+
+def decrypt_table_bytewise(encryptedItem):
+    """ Original per-byte table decryption (reference for benchmark) """
+    lookUpTable = cbfcipher.Table.lut
+    itemLength = len(encryptedItem)
+    decryptedItem = bytearray(itemLength)
+
+    key = itemLength
+    for pos in range(itemLength):
+        encryptedByte = encryptedItem[pos]
+        decryptedItem[pos] = encryptedByte ^ lookUpTable[key & 0xF]
+        key = encryptedByte
+
+    return bytes(decryptedItem)
+
+def bench_function(func, data):
+    start = time.perf_counter()
+    func(data)
+    return time.perf_counter() - start
+
+def bench_cipher(args):
+    data = os.urandom(args.size * 1024 * 1024)
+    sample = data[:args.old_size * 1024 * 1024]
+    logging.info("NumPy: {}".format("yes" if cbfcipher.numpy is not None else "no"))
+
+    for (name, func, input) in [
+            ("decrypt_file", cbfcipher.decrypt_file, data),
+            ("encrypt_file", cbfcipher.encrypt_file, data),
+            ("decrypt_table", cbfcipher.decrypt_table, data),
+            ("encrypt_table", cbfcipher.encrypt_table, sample),
+            ("file (old)", decrypt_file_bytewise, sample),
+            ("table (old)", decrypt_table_bytewise, sample)]:
+        report(name, len(input), bench_function(func, input))
+
+class Corpus:
+    """ Deterministic synthetic content and archives for benchmarks """
+
+    words = [b"vietcong", b"model", b"texture", b"weapon", b"soldier", b"jungle",
+        b"helicopter", b"river", b"village", b"script", b"sound", b"level"]
+
+    # name, version, mode, comment, files, file size, content, compress
+    specs = [
+        ("zbl0-text", cbf.CBFArchive.Version.ZBL0, cbf.CBFArchive.Mode.extended, None, 200, 0x4000, "text", True),
+        ("zbl1-mixed", cbf.CBFArchive.Version.ZBL1, cbf.CBFArchive.Mode.extended, "BENCH", 200, 0x4000, "mixed", True),
+        ("zbl1-stored", cbf.CBFArchive.Version.ZBL1, cbf.CBFArchive.Mode.classic, None, 100, 0x10000, "random", False),
+        ("zbl1-zeros", cbf.CBFArchive.Version.ZBL1, cbf.CBFArchive.Mode.extended, None, 4, 0x40000, "zeros", True),
+        ("zbl1-random-lzw", cbf.CBFArchive.Version.ZBL1, cbf.CBFArchive.Mode.extended, None, 16, 0x10000, "random", True),
+    ]
+
+    def content(rand, kind, size):
+        """
+        Return content of given kind: text (compressible), binary (small alphabet),
+        random (incompressible, maximal dictionary growth), zeros (longest
+        dictionary strings and KwKwK codes only) or mixed
+        """
+        if kind == "mixed":
+            kind = rand.choice(["text", "binary", "random", "zeros"])
+
+        if kind == "text":
+            data = bytearray(0)
+            while len(data) < size:
+                data += rand.choice(Corpus.words) + rand.choice([b" ", b"\n", b"_"])
+            return bytes(data[:size])
+        elif kind == "binary":
+            return bytes([rand.randrange(16) for pos in range(size)])
+        elif kind == "random":
+            return rand.getrandbits(size * 8).to_bytes(size, "little")
+        else:
+            return bytes(size)
+
+    def generate(fileName, version, mode, comment, files, size, kind, compress, seed=0,
+            blockSize=cbfpack.CBFWriter.Default.blockSize):
+        """ Write synthetic archive, compressed files are never stored as fallback """
+        rand = random.Random(seed)
+        dateTime = 0x01D0000000000000 + seed
+        with open(fileName, "w+b") as fileWrite:
+            writer = cbfpack.CBFWriter(fileWrite, version, mode, comment, blockSize, dateTime, False)
+            for fileID in range(files):
+                name = "bench\\dir{}\\file{:05}.{}".format(fileID % 8, fileID, kind)
+                writer.add_data(name, Corpus.content(rand, kind, size), compress, dateTime + fileID)
+            writer.close()
+
+    def generate_all(directory, scale=1.0, seed=0):
+        """ Write all standard archives into directory and return their names """
+        fileNames = []
+        for (name, version, mode, comment, files, size, kind, compress) in Corpus.specs:
+            fileName = os.path.join(directory, name + ".cbf")
+            logging.info("Generating " + fileName)
+            Corpus.generate(fileName, version, mode, comment, max(1, int(files * scale)),
+                size, kind, compress, seed)
+            fileNames.append(fileName)
+        return fileNames
+
+def bench_stages(fileName):
+    """
+    Measure table parsing, decryption, inflation and end-to-end extraction
+    of archive, return list of result dictionaries
+    """
+    results = []
+
+    def result(stage, size, elapsed):
+        report(stage, size, elapsed)
+        results.append({"archive": os.path.basename(fileName), "stage": stage, "bytes": size,
+            "seconds": round(elapsed, 6),
+            "MBps": round(size / elapsed / 1e6, 3) if elapsed > 0 else None})
+
+    logging.info("Archive: " + fileName)
+    data = cbf.map_file(fileName)
+
+    start = time.perf_counter()
+    archive = cbf.CBFArchive(fileName, data)
+    (fileCnt, fileTable) = archive.parse_header()
+    fileList = archive.parse_table(fileTable)
+    result("table", len(fileTable), time.perf_counter() - start)
+
+    encrypted = [file for file in fileList if file.compressed == 0 and file.version == cbf.CBFArchive.Version.ZBL1]
+    if encrypted:
+        start = time.perf_counter()
+        size = sum([len(file.decrypt()) for file in encrypted])
+        result("decrypt", size, time.perf_counter() - start)
+
+    compressed = [file for file in fileList if file.compressed == 1]
+    if compressed:
+        start = time.perf_counter()
+        size = sum([len(file.decompress()) for file in compressed])
+        result("inflate", size, time.perf_counter() - start)
+
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            start = time.perf_counter()
+            archive = cbf.CBFArchive.map(os.path.join(cwd, fileName), fileName)
+            archive.parse(True)
+            result("extract", sum([file.size for file in archive.fileList]), time.perf_counter() - start)
+        finally:
+            os.chdir(cwd)
+
+    return results
+
+def bench_table(args):
+    """ Compare memory of compact CBFTable with list of CBFFile objects """
+    with tempfile.TemporaryDirectory() as directory:
+        fileNames = args.archive
+        if not fileNames:
+            fileName = os.path.join(directory, "table.cbf")
+            Corpus.generate(fileName, cbf.CBFArchive.Version.ZBL1, cbf.CBFArchive.Mode.extended,
+                None, args.files, 16, "text", False)
+            fileNames = [fileName]
+
+        for fileName in fileNames:
+            logging.info("Archive: " + fileName)
+            archive = cbf.CBFArchive(fileName, cbf.map_file(fileName))
+            (fileCnt, fileTable) = archive.parse_header()
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            table = archive.parse_table(fileTable)
+            elapsed = time.perf_counter() - start
+            tableSize = tracemalloc.get_traced_memory()[0]
+            fileList = list(table)
+            listSize = tracemalloc.get_traced_memory()[0] - tableSize
+            tracemalloc.stop()
+
+            count = max(len(table), 1)
+            report("table", len(fileTable), elapsed)
+            logging.info("{:<14} {:>12} B {:>10.1f} B/file".format("CBFTable", tableSize, tableSize / count))
+            logging.info("{:<14} {:>12} B {:>10.1f} B/file".format("CBFFile list", listSize, listSize / count))
+
+def bench_run(args):
+    with tempfile.TemporaryDirectory() as directory:
+        fileNames = args.archive
+        if not fileNames:
+            fileNames = Corpus.generate_all(directory, args.scale, args.seed)
+
+        results = []
+        for fileName in fileNames:
+            results.extend(bench_stages(fileName))
+
+    if args.json:
+        output = {"python": platform.python_version(), "numpy": cbfcipher.numpy is not None,
+            "results": results}
+        with open(args.json, "w") as f:
+            json.dump(output, f, indent=1, sort_keys=True)
+
+def bench_generate(args):
+    if args.standard:
+        os.makedirs(args.output, exist_ok=True)
+        Corpus.generate_all(args.output, args.scale, args.seed)
+        return
+
+    version = cbf.CBFArchive.Version.ZBL0 if args.zbl0 else cbf.CBFArchive.Version.ZBL1
+    mode = cbf.CBFArchive.Mode.classic if args.classic else cbf.CBFArchive.Mode.extended
+    Corpus.generate(args.output, version, mode, args.comment, args.files, args.size,
+        args.content, not args.store, args.seed, args.block_size)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="bench")
+
+    lzwParser = subparsers.add_parser("lzw",
+        help="compare throughput of LZW decoders on compressed files of ARCHIVE")
+    lzwParser.add_argument("archive",
+        nargs="+")
+    lzwParser.add_argument("--limit",
+        help="skip LZW blocks bigger than LIMIT bytes (after decompression)",
+        type=int)
+    lzwParser.add_argument("--skip-old",
+        help="do not benchmark original (quadratic) LZW decoder",
+        action="store_true")
+
+    cipherParser = subparsers.add_parser("cipher",
+        help="measure throughput of ZBL1 ciphers on random data")
+    cipherParser.add_argument("--size",
+        help="size of input data in MiB (default: 100)",
+        type=int, default=100)
+    cipherParser.add_argument("--old-size",
+        help="size of input data in MiB for sequential algorithms (default: 1)",
+        type=int, default=1)
+
+    generateParser = subparsers.add_parser("generate",
+        help="generate deterministic synthetic archive OUTPUT")
+    generateParser.add_argument("output")
+    generateParser.add_argument("--standard",
+        help="generate all standard benchmark archives into OUTPUT directory",
+        action="store_true")
+    generateParser.add_argument("--zbl0",
+        help="create ZBL0 archive (default is ZBL1)",
+        action="store_true")
+    generateParser.add_argument("--classic",
+        help="create classic ZBL1 archive",
+        action="store_true")
+    generateParser.add_argument("--comment")
+    generateParser.add_argument("--files",
+        help="number of files (default: 100)",
+        type=int, default=100)
+    generateParser.add_argument("--size",
+        help="size of each file (default: 16384)",
+        type=int, default=0x4000)
+    generateParser.add_argument("--content",
+        help="content of files (default: text)",
+        choices=["text", "binary", "random", "zeros", "mixed"], default="text")
+    generateParser.add_argument("--store",
+        help="do not compress files",
+        action="store_true")
+    generateParser.add_argument("--block-size",
+        help="size of LZW block",
+        type=int, default=cbfpack.CBFWriter.Default.blockSize)
+
+    tableParser = subparsers.add_parser("table",
+        help="compare memory of compact table and list of file objects of ARCHIVE (generated by default)")
+    tableParser.add_argument("archive",
+        nargs="*")
+    tableParser.add_argument("--files",
+        help="number of files of generated archive (default: 50000)",
+        type=int, default=50000)
+
+    runParser = subparsers.add_parser("run",
+        help="measure throughput of CBF processing stages on ARCHIVE (standard corpus by default)")
+    runParser.add_argument("archive",
+        nargs="*")
+    runParser.add_argument("--json",
+        help="write results into JSON file")
+
+    for subparser in [generateParser, runParser]:
+        subparser.add_argument("--seed",
+            help="seed of generated content (default: 0)",
+            type=int, default=0)
+        subparser.add_argument("--scale",
+            help="scale number of files of standard archives (default: 1.0)",
+            type=float, default=1.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.bench == "lzw":
+        bench_lzw(args)
+    elif args.bench == "cipher":
+        bench_cipher(args)
+    elif args.bench == "generate":
+        bench_generate(args)
+    elif args.bench == "table":
+        bench_table(args)
+    elif args.bench == "run":
+        bench_run(args)
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  version 2 as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""
+cbfcat.py - SQLite catalog of files of all CBF archives of game installation
+"""
+
+import sys
+import argparse
+import os
+import ntpath
+import struct
+import sqlite3
+import logging
+
+from cbf import CBFArchive, map_file
+
+__author__ = "Jan Havran"
+
+class Catalog(object):
+    """
+    Catalog of files stored in CBF archives.
+
+    Only headers and tables of archives are parsed. Archive is parsed again
+    on refresh only if its size or modification time changed. File names
+    are indexed (case-insensitively) by full path and by extension and size.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS archives (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            mode INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            archive INTEGER NOT NULL REFERENCES archives(id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            ext TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            storedSize INTEGER NOT NULL,
+            storage INTEGER NOT NULL,
+            dateTime INTEGER NOT NULL,
+            offset INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS filesKey ON files (key);
+        CREATE INDEX IF NOT EXISTS filesExt ON files (ext, size);
+        CREATE INDEX IF NOT EXISTS filesArchive ON files (archive);
+    """
+
+    def __init__(self, dbName):
+        self.db = sqlite3.connect(dbName)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(Catalog.schema)
+
+    def close(self):
+        self.db.close()
+
+    def archives(roots):
+        """ Return absolute paths of all CBF archives in given directories (or archives) """
+        paths = []
+        for root in roots:
+            if not os.path.isdir(root):
+                paths.append(os.path.abspath(root))
+                continue
+            for (dirPath, dirs, fileNames) in os.walk(root):
+                for fileName in fileNames:
+                    if fileName.lower().endswith(".cbf"):
+                        paths.append(os.path.abspath(os.path.join(dirPath, fileName)))
+        return sorted(paths)
+
+    def add(self, path, st):
+        """ Parse table of archive and replace its files in catalog """
+        archive = CBFArchive(path, map_file(path))
+        (fileCnt, fileTable) = archive.parse_header()
+        fileList = archive.parse_table(fileTable)
+
+        self.db.execute("DELETE FROM archives WHERE path = ?", (path,))
+        archiveId = self.db.execute("INSERT INTO archives (path, size, mtime, version, mode) VALUES (?, ?, ?, ?, ?)",
+            (path, st.st_size, st.st_mtime_ns, archive.fileVer[0], archive.fileMode)).lastrowid
+        self.db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(archiveId, file.name, CBFArchive.index_key(file.name),
+            ntpath.splitext(file.name)[1].lower(), file.size, len(file.data),
+            file.compressed, file.dateTime, file.offset) for file in fileList])
+        return len(fileList)
+
+    def refresh(self, roots):
+        """
+        Add new and changed archives found in roots and remove archives
+        which no longer exist, return (added or updated, removed, unchanged)
+        """
+        known = dict([(path, (size, mtime)) for (path, size, mtime) in
+            self.db.execute("SELECT path, size, mtime FROM archives")])
+        (updated, unchanged) = (0, 0)
+
+        with self.db:
+            paths = Catalog.archives(roots)
+            for path in paths:
+                try:
+                    st = os.stat(path)
+                    if known.get(path) == (st.st_size, st.st_mtime_ns):
+                        unchanged += 1
+                        continue
+
+                    logging.log(logging.VERBOSE, "Archive: " + path)
+                    self.add(path, st)
+                    updated += 1
+                except (OSError, RuntimeError, struct.error, ValueError) as e:
+                    # skip malformed archive (struct.error, UnicodeDecodeError), keep indexing the rest
+                    logging.error("{}: {}".format(path, str(e).strip()))
+                    self.db.execute("DELETE FROM archives WHERE path = ?", (path,))
+
+            # archives under refreshed roots which were not found any more
+            prefixes = [os.path.join(os.path.abspath(root), "") for root in roots if os.path.isdir(root)]
+            removed = [path for path in known if path not in set(paths) and
+                any([path.startswith(prefix) for prefix in prefixes])]
+            self.db.executemany("DELETE FROM archives WHERE path = ?", [(path,) for path in removed])
+
+        return (updated, len(removed), unchanged)
+
+    def query(self, where, args):
+        return self.db.execute("SELECT archives.path, files.name, files.size, files.storedSize, files.storage "
+            "FROM files JOIN archives ON files.archive = archives.id WHERE " + where +
+            " ORDER BY archives.path, files.key", args).fetchall()
+
+    def which(self, name):
+        """ Return (archive, name, size, stored size, storage) of files of given full path """
+        return self.query("files.key = ?", (CBFArchive.index_key(name),))
+
+    def find(self, prefix=None, ext=None, larger=None):
+        """ Return files with name starting with prefix, with extension and larger than given size """
+        conditions = []
+        args = []
+        if prefix:
+            # range instead of LIKE, so the index is used
+            conditions.append("files.key >= ? AND files.key < ?")
+            prefix = CBFArchive.index_key(prefix)
+            args.extend([prefix, prefix + "\uffff"])
+        if ext is not None:
+            conditions.append("files.ext = ?")
+            args.append(("." + ext.lower()).replace("..", "."))
+        if larger is not None:
+            conditions.append("files.size > ?")
+            args.append(larger)
+        return self.query(" AND ".join(conditions) if conditions else "1", args)
+
+if __name__ == "__main__":
+    level = logging.INFO
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--database",
+        help="catalog database (default: $CBF_CATALOG or cbfcat.sqlite)",
+        default=os.environ.get("CBF_CATALOG", "cbfcat.sqlite"))
+    parser.add_argument("-v", "--verbose",
+        help="verbose mode ON",
+        action="store_true")
+    subparsers = parser.add_subparsers(dest="command")
+
+    updateParser = subparsers.add_parser("update",
+        help="add new and changed archives of game installation into catalog")
+    updateParser.add_argument("root",
+        help="directory (searched recursively) or archive",
+        nargs="+")
+
+    whichParser = subparsers.add_parser("which",
+        help="print archives containing file of given full path")
+    whichParser.add_argument("name")
+
+    findParser = subparsers.add_parser("find",
+        help="print files matching all given conditions")
+    findParser.add_argument("--prefix",
+        help="full path of file starts with PREFIX")
+    findParser.add_argument("--ext",
+        help="file has extension EXT (e.g. bes)")
+    findParser.add_argument("--larger",
+        help="file is larger than LARGER bytes",
+        type=int)
+    args = parser.parse_args()
+
+    if args.verbose:
+        level = logging.VERBOSE
+
+    logging.basicConfig(level=level, format="%(message)s")
+
+    if args.command is None:
+        parser.print_help()
+        sys.exit(1)
+
+    catalog = Catalog(args.database)
+    try:
+        if args.command == "update":
+            (updated, removed, unchanged) = catalog.refresh(args.root)
+            logging.info("{} archives updated, {} removed, {} unchanged".format(updated, removed, unchanged))
+        else:
+            if args.command == "which":
+                rows = catalog.which(args.name)
+            else:
+                rows = catalog.find(args.prefix, args.ext, args.larger)
+            for (path, name, size, storedSize, storage) in rows:
+                print("{}\t{}\t{}\t{}\t{}".format(path, name, size, storedSize, storage))
+            if not rows:
+                sys.exit(1)
+    finally:
+        catalog.close()
@@ -0,0 +1,107 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  version 2 as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""
+cbfcipher.py - bulk encryption and decryption of ZBL1 CBF archives
+
+ZBL1 uses two ciphers (see doc/cbf.md):
+  * file cipher - every byte is mapped by fixed function of file length,
+    so whole file is processed by one bytes.translate call,
+  * table cipher - every byte is XORed with lut value indexed by previous
+    encrypted byte, so key stream of decryption is known in advance and
+    is applied at once (with NumPy if available).
+"""
+
+__author__ = "Jan Havran"
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class File:
+    salt = 0xA6
+
+    def decryptTable(key):
+        """ Return translation table decrypting file with given key """
+        key &= 0xFF
+        return bytes([((val + File.salt + key) & 0xFF) ^ key for val in range(256)])
+
+    def encryptTable(key):
+        """ Return translation table encrypting file with given key """
+        key &= 0xFF
+        return bytes([((val ^ key) - File.salt - key) & 0xFF for val in range(256)])
+
+class Table:
+    lut = [0x32, 0xF3, 0x1E, 0x06, 0x45, 0x70, 0x32, 0xAA, 0x55, 0x3F, 0xF1, 0xDE, 0xA3, 0x44, 0x21, 0xB4]
+
+# lut extended for indexing by whole (8b) key
+_tableKeys = bytes([Table.lut[key & 0xF] for key in range(256)])
+_fileDecryptTables = [File.decryptTable(key) for key in range(256)]
+_fileEncryptTables = [File.encryptTable(key) for key in range(256)]
+
+def decrypt_file(data, key=None):
+    """
+    Decrypt ZBL1 file. Key is the file length by default,
+    it has to be given explicitly when decrypting only part of the file.
+    """
+    if key is None:
+        key = len(data)
+    return bytes(data).translate(_fileDecryptTables[key & 0xFF])
+
+def encrypt_file(data, key=None):
+    """ Encrypt ZBL1 file (inverse of decrypt_file) """
+    if key is None:
+        key = len(data)
+    return bytes(data).translate(_fileEncryptTables[key & 0xFF])
+
+def xor_bytes(a, b):
+    """ Return a XOR b for two byte strings of the same length """
+    if numpy is not None:
+        return numpy.bitwise_xor(numpy.frombuffer(a, dtype=numpy.uint8),
+            numpy.frombuffer(b, dtype=numpy.uint8)).tobytes()
+
+    return (int.from_bytes(a, "little") ^ int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+def decrypt_table(data, key=None):
+    """
+    Decrypt ZBL1 file descriptor. Key is the descriptor length by default,
+    otherwise key is the last encrypted byte preceding given data.
+    """
+    data = bytes(data)
+    if not data:
+        return data
+    if key is None:
+        key = len(data)
+
+    keys = bytes([key & 0xFF]) + data[:-1]
+    return xor_bytes(data, keys.translate(_tableKeys))
+
+def encrypt_table(data, key=None):
+    """
+    Encrypt ZBL1 file descriptor (inverse of decrypt_table).
+    Every key depends on previous encrypted byte, so this one is sequential.
+    """
+    if key is None:
+        key = len(data)
+
+    encrypted = bytearray(len(data))
+    for pos, val in enumerate(data):
+        key = val ^ _tableKeys[key & 0xFF]
+        encrypted[pos] = key
+
+    return bytes(encrypted)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  version 2 as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""
+cbfd.py - daemon serving files of CBF archives over Unix domain socket
+
+Archives (and directories) are mounted once into cbfvfs.VFS and kept
+mapped, clients send requests over simple length-prefixed protocol:
+  * request:  command (UINT8), path size (UINT32LE), path (UTF-8)
+  * response: status (UINT8), body size (UINT32LE), body
+Commands are read (body is file content), stat (body is JSON object)
+and list (body is NULL separated names of directory).
+"""
+
+import sys
+import os
+import argparse
+import asyncio
+import socket
+import stat
+import struct
+import json
+import logging
+
+from cbf import CBFIndexCache, CBFDataCache
+from cbfvfs import VFS
+
+__author__ = "Jan Havran"
+
+class Protocol:
+    request = struct.Struct("<BI")
+    response = struct.Struct("<BI")
+
+    class Command:
+        read = ord('R')
+        stat = ord('S')
+        list = ord('L')
+
+    class Status:
+        ok = 0
+        notFound = 1
+        error = 2
+
+    def socketPath():
+        """ Return default socket path """
+        return os.environ.get("CBFD_SOCKET", os.path.join("/tmp", "cbfd-{}.sock".format(os.getuid())))
+
+class CBFServer(object):
+    def __init__(self, vfs):
+        self.vfs = vfs
+
+    def handle(self, command, pathData):
+        """ Process single request (path is UTF-8 encoded) and return (status, body) """
+        try:
+            path = pathData.decode("utf-8")
+        except UnicodeDecodeError:
+            return (Protocol.Status.error, b"Invalid path (not UTF-8)")
+
+        try:
+            if command == Protocol.Command.read:
+                return (Protocol.Status.ok, self.vfs.read(path))
+            elif command == Protocol.Command.stat:
+                entry = self.vfs.stat(path)
+                return (Protocol.Status.ok, json.dumps({"name": entry.name, "size": entry.size,
+                    "dateTime": entry.dateTime, "compressed": entry.compressed,
+                    "source": entry.mount.path}).encode("utf-8"))
+            elif command == Protocol.Command.list:
+                return (Protocol.Status.ok, "\x00".join(self.vfs.listdir(path)).encode("utf-8"))
+            else:
+                return (Protocol.Status.error, b"Unknown command")
+        except KeyError:
+            return (Protocol.Status.notFound, b"")
+        except (OSError, RuntimeError) as e:
+            logging.error("{}: {}".format(path, str(e).strip()))
+            return (Protocol.Status.error, str(e).strip().encode("utf-8"))
+
+    async def client(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                (command, pathSize) = Protocol.request.unpack(
+                    await reader.readexactly(Protocol.request.size))
+                path = await reader.readexactly(pathSize)
+
+                if command == Protocol.Command.read:
+                    # decoding may take a while, do not block other clients
+                    (status, body) = await loop.run_in_executor(None, self.handle, command, path)
+                else:
+                    (status, body) = self.handle(command, path)
+
+                writer.write(Protocol.response.pack(status, len(body)))
+                writer.write(body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def remove_stale(socketPath):
+        """ Remove socket left by daemon which is not running any more, refuse other files """
+        if not os.path.lexists(socketPath):
+            return
+        if not stat.S_ISSOCK(os.lstat(socketPath).st_mode):
+            raise RuntimeError("Not a socket: " + socketPath)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socketPath)
+        except OSError:
+            os.unlink(socketPath)
+            return
+        finally:
+            sock.close()
+        raise RuntimeError("Another daemon is listening on " + socketPath)
+
+    async def serve(self, socketPath):
+        CBFServer.remove_stale(socketPath)
+        server = await asyncio.start_unix_server(self.client, socketPath)
+        logging.info("Listening on " + socketPath)
+        async with server:
+            await server.serve_forever()
+
+class CBFClient(object):
+    """ Blocking client of cbfd daemon """
+    def __init__(self, socketPath=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(Protocol.socketPath() if socketPath is None else socketPath)
+
+    def close(self):
+        self.sock.close()
+
+    def recv(self, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        pos = 0
+        while pos < size:
+            received = self.sock.recv_into(view[pos:])
+            if received == 0:
+                raise ConnectionError("Connection closed by daemon")
+            pos += received
+        return bytes(data)
+
+    def request(self, command, path):
+        """ Send request and return its body, raise KeyError if file does not exist """
+        path = path.encode("utf-8")
+        self.sock.sendall(Protocol.request.pack(command, len(path)) + path)
+        (status, bodySize) = Protocol.response.unpack(self.recv(Protocol.response.size))
+        body = self.recv(bodySize)
+
+        if status == Protocol.Status.notFound:
+            raise KeyError(path.decode("utf-8"))
+        if status != Protocol.Status.ok:
+            raise RuntimeError(body.decode("utf-8"))
+        return body
+
+    def read(self, path):
+        return self.request(Protocol.Command.read, path)
+
+    def stat(self, path):
+        return json.loads(self.request(Protocol.Command.stat, path).decode("utf-8"))
+
+    def listdir(self, path=""):
+        body = self.request(Protocol.Command.list, path).decode("utf-8")
+        return body.split("\x00") if body else []
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--socket",
+        help="path of Unix socket (default: $CBFD_SOCKET or /tmp/cbfd-UID.sock)")
+    subparsers = parser.add_subparsers(dest="command")
+
+    serveParser = subparsers.add_parser("serve",
+        help="mount archives and directories and serve their files")
+    serveParser.add_argument("mount",
+        help="archive or directory (earlier mounts have higher priority)",
+        nargs="+")
+    serveParser.add_argument("--cache",
+        help="use index cache of archive tables",
+        action="store_true")
+    serveParser.add_argument("--data-cache",
+        help="keep up to DATA_CACHE MiB of extracted files in memory",
+        type=int, default=0)
+
+    for (command, help) in [("read", "write file to stdout"),
+            ("stat", "print file details"), ("ls", "list directory")]:
+        commandParser = subparsers.add_parser(command, help=help)
+        commandParser.add_argument("path",
+            nargs="?", default="")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    socketPath = Protocol.socketPath() if args.socket is None else args.socket
+
+    if args.command == "serve":
+        dataCache = CBFDataCache(args.data_cache * 1024 * 1024, True) if args.data_cache else None
+        server = CBFServer(VFS(args.mount, CBFIndexCache() if args.cache else None, dataCache))
+        try:
+            asyncio.run(server.serve(socketPath))
+        except KeyboardInterrupt:
+            pass
+        except (OSError, RuntimeError) as e:
+            logging.error(e)
+            sys.exit(1)
+    elif args.command in ["read", "stat", "ls"]:
+        client = CBFClient(socketPath)
+        try:
+            if args.command == "read":
+                sys.stdout.buffer.write(client.read(args.path))
+            elif args.command == "stat":
+                print(json.dumps(client.stat(args.path)))
+            else:
+                for name in client.listdir(args.path):
+                    print(name)
+        except KeyError:
+            logging.error("No such file or directory: " + args.path)
+            sys.exit(1)
+        except RuntimeError as e:
+            logging.error(e)
+            sys.exit(1)
+        finally:
+            client.close()
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  version 2 as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""
+cbfpack.py - util for packing files into CBF archives
+"""
+
+import sys
+import argparse
+import struct
+import os
+import io
+import time
+import hashlib
+import logging
+
+import cbfcipher
+from cbf import CBFArchive, LZW, filetime
+
+__author__ = "Jan Havran"
+
+logging.VERBOSE = logging.DEBUG + 5
+
+class LZWEncoder(object):
+    """
+    LZW compressor producing blocks readable by LZWDecoder.
+
+    Dictionary maps (prefix code, next byte) into code by single Python dict
+    keyed by integer (prefix << 8 | byte). Key width follows the decoder,
+    which appends dictionary row one code later than the encoder.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def compress(self):
+        codeEnd = (1 << LZW.Default.dictWidth)
+        dictWidth = LZW.Default.dictWidth + 1
+        codeMax = (1 << dictWidth) - 1
+        decoderLen = codeEnd + 1
+        codeNext = codeEnd + 1
+        LZWDict = dict()
+
+        data = bytearray(0)
+        word = 0
+        wordBits = 0
+        codes = 0
+
+        keyPrev = -1
+        for val in self.data:
+            if keyPrev < 0:
+                keyPrev = val
+                continue
+
+            row = (keyPrev << 8) | val
+            key = LZWDict.get(row)
+            if key is not None:
+                keyPrev = key
+                continue
+
+            word |= keyPrev << wordBits
+            wordBits += dictWidth
+            if wordBits >= 32:
+                data += (word & 0xFFFFFFFF).to_bytes(4, 'little')
+                word >>= 32
+                wordBits -= 32
+
+            codes += 1
+            if codes >= 2:
+                decoderLen += 1
+                if decoderLen >= codeMax:
+                    dictWidth += 1
+                    codeMax = (1 << dictWidth) - 1
+
+            LZWDict[row] = codeNext
+            codeNext += 1
+            keyPrev = val
+
+        for key in ([keyPrev] if keyPrev >= 0 else []) + [codeEnd]:
+            word |= key << wordBits
+            wordBits += dictWidth
+            codes += 1
+            if codes >= 2 and key != codeEnd:
+                decoderLen += 1
+                if decoderLen >= codeMax:
+                    dictWidth += 1
+                    codeMax = (1 << dictWidth) - 1
+
+        data += word.to_bytes((wordBits + 7) // 8, 'little')
+        return bytes(data)
+
+class CBFWriter(object):
+    """
+    Streaming CBF archive writer (inverse of CBFArchive).
+
+    Files are compressed/encrypted and written one by one as they are added,
+    only their descriptors are kept in memory. Table of Files is written
+    at the end and header is updated afterwards, so output has to be seekable.
+    """
+
+    class Default:
+        blockSize = 0x10000
+        chunkSize = 0x100000
+
+    def __init__(self, fileWrite, version=CBFArchive.Version.ZBL1, mode=CBFArchive.Mode.extended,
+            comment=None, blockSize=Default.blockSize, dateTime=None, storeUncompressible=True):
+        if version == CBFArchive.Version.ZBL0:
+            mode = CBFArchive.Mode.extended
+            if comment is not None:
+                raise RuntimeError("  ZBL0 archives can not contain comment")
+        if mode == CBFArchive.Mode.classic and comment is not None:
+            raise RuntimeError("  Classic archives can not contain comment")
+
+        self.fileWrite = fileWrite
+        self.version = version
+        self.mode = mode
+        self.blockSize = blockSize
+        self.storeUncompressible = storeUncompressible
+        self.dateTime = filetime(time.time_ns()) if dateTime is None else dateTime
+        self.descriptors = []
+
+        if mode == CBFArchive.Mode.classic:
+            self.headerSize = 0
+            self.extension = b''
+        elif comment is None:
+            self.headerSize = 64
+            self.extension = struct.pack("<III", 0, 0, 0)
+        else:
+            comment = comment.encode('windows-1250') + b'\x00'
+            self.headerSize = 70 + len(comment)
+            self.extension = struct.pack("<IIIHI", 0, 0, 0, 1, len(comment)) + comment
+
+        self.start = fileWrite.tell()
+        self.fileWrite.write(bytes(CBFArchive.Header.size + len(self.extension)))
+
+    def tell(self):
+        return self.fileWrite.tell() - self.start
+
+    def add_descriptor(self, name, size, offset, storedSize, storageType, dateTime):
+        if self.mode == CBFArchive.Mode.classic:
+            dateTime = 0
+
+        self.descriptors.append(struct.pack("<IIIIIIIIII", offset, 0, 0,
+            dateTime & 0xFFFFFFFF, dateTime >> 32, size, 0,
+            storedSize if storageType == 1 else 0, storageType, 0) +
+            name.encode('windows-1250') + b'\x00')
+
+    def add_stored(self, name, size, chunks, storageType, dateTime=0):
+        """
+        Add file which is already stored (compressed or encrypted) as given
+        by iterable of chunks - e.g. copied verbatim from another archive
+        """
+        offset = self.tell()
+        for chunk in chunks:
+            self.fileWrite.write(chunk)
+        self.add_descriptor(name, size, offset, self.tell() - offset, storageType, dateTime)
+
+    def add_stream(self, name, fileRead, size, compress=True, dateTime=0):
+        """
+        Add file of given size read from fileRead.
+        Compressed file larger than its stored variant is stored instead
+        (unless disabled by storeUncompressible).
+        """
+        offset = self.tell()
+        storageType = 0
+
+        if compress and size > 0:
+            for pos in range(0, size, self.blockSize):
+                block = fileRead.read(self.blockSize)
+                blockCompressed = LZWEncoder(block).compress()
+                self.fileWrite.write(struct.pack("<4sII", LZW.Header.sig, len(blockCompressed), len(block)))
+                self.fileWrite.write(blockCompressed)
+
+            if self.tell() - offset < size or not self.storeUncompressible:
+                storageType = 1
+            else:
+                logging.log(logging.VERBOSE, "  storing uncompressible file: " + name)
+                fileRead.seek(-size, io.SEEK_CUR)
+                self.fileWrite.seek(self.start + offset)
+
+        if storageType == 0:
+            for pos in range(0, size, CBFWriter.Default.chunkSize):
+                chunk = fileRead.read(CBFWriter.Default.chunkSize)
+                if self.version == CBFArchive.Version.ZBL1:
+                    chunk = cbfcipher.encrypt_file(chunk, size)
+                self.fileWrite.write(chunk)
+
+        self.add_descriptor(name, size, offset, self.tell() - offset, storageType, dateTime)
+
+    def add_data(self, name, data, compress=True, dateTime=0):
+        """ Add file with content given as bytes """
+        self.add_stream(name, io.BytesIO(data), len(data), compress, dateTime)
+
+    def add_file(self, name, path, compress=True):
+        """ Add file from disk (stored under given name) """
+        with open(path, "rb") as fileRead:
+            st = os.fstat(fileRead.fileno())
+            self.add_stream(name, fileRead, st.st_size, compress, filetime(st.st_mtime_ns))
+
+    def close(self):
+        """ Write Table of Files and header """
+        tableOffset = self.tell()
+        for desc in self.descriptors:
+            if self.version == CBFArchive.Version.ZBL1:
+                self.fileWrite.write(struct.pack("<H", len(desc)) + cbfcipher.encrypt_table(desc))
+            else:
+                self.fileWrite.write(desc)
+        tableSize = self.tell() - tableOffset
+        archiveSize = self.tell()
+        self.fileWrite.truncate()
+
+        dateTime = 0 if self.mode == CBFArchive.Mode.classic else self.dateTime
+        header = struct.pack("<4s4sIIIIIIIIIII", CBFArchive.Header.sig, self.version,
+            archiveSize, 0, len(self.descriptors), tableOffset, 0, tableSize, 0,
+            self.headerSize, 0, dateTime & 0xFFFFFFFF, dateTime >> 32)
+        self.fileWrite.seek(self.start)
+        self.fileWrite.write(header + self.extension)
+        self.fileWrite.seek(self.start + archiveSize)
+
+def collectFiles(paths):
+    """
+    Return list of (archive name, path) for given files and directories.
+    Files in directories are stored with path relative to that directory.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            dirFiles = []
+            for (root, dirs, fileNames) in os.walk(path):
+                for fileName in fileNames:
+                    filePath = os.path.join(root, fileName)
+                    dirFiles.append((os.path.relpath(filePath, path).replace(os.sep, "\\"), filePath))
+            files.extend(sorted(dirFiles))
+        else:
+            files.append((os.path.basename(path), path))
+
+    return files
+
+def hashFile(path):
+    with open(path, "rb") as f:
+        return hashlib.blake2b(f.read()).digest()
+
+def verifyArchive(archiveName, files):
+    """ Read written archive by CBFArchive and compare it with source files """
+    archive = CBFArchive.open(archiveName)
+    errors = 0
+
+    for (name, path) in files:
+        try:
+            data = archive.read(name)
+        except KeyError:
+            logging.error("  Missing file: " + name)
+            errors += 1
+            continue
+        if hashlib.blake2b(data).digest() != hashFile(path):
+            logging.error("  Content does not match: " + name)
+            errors += 1
+
+    return errors == 0
+
+def isUnchanged(file, path, checksum):
+    """
+    Decide whether archived file matches file on disk - by size and timestamp,
+    or (with checksum) by content when only timestamp differs
+    """
+    st = os.stat(path)
+    if file.size != st.st_size or file.compressed not in [0, 1]:
+        return False
+    if file.dateTime == filetime(st.st_mtime_ns):
+        return True
+    if not checksum:
+        return False
+
+    fileHash = hashlib.blake2b()
+    for chunk in file.extractChunks():
+        fileHash.update(chunk)
+    return fileHash.digest() == hashFile(path)
+
+def updateArchive(archiveName, files, compress, blockSize, checksum):
+    """
+    Rebuild archive with given files: stored data of unchanged files are
+    copied verbatim, only changed and new files are compressed again.
+    Files missing in the list are kept as they are.
+    """
+    logging.info("Archive: " + archiveName)
+    archive = CBFArchive.open(archiveName)
+    sources = dict()
+    for (name, path) in files:
+        sources[CBFArchive.index_key(name)] = (name, path)
+
+    tmpName = archiveName + ".tmp"
+    with open(tmpName, "w+b") as fileWrite:
+        writer = CBFWriter(fileWrite, archive.fileVer, archive.fileMode, archive.comment, blockSize)
+        for file in archive.fileList:
+            source = sources.pop(CBFArchive.index_key(file.name), None)
+            if source is None:
+                logging.log(logging.VERBOSE, "  keeping: " + file.name)
+                writer.add_stored(file.name, file.size, [file.data], file.compressed, file.dateTime)
+            elif isUnchanged(file, source[1], checksum):
+                logging.log(logging.VERBOSE, "  keeping: " + file.name)
+                writer.add_stored(file.name, file.size, [file.data], file.compressed,
+                    filetime(os.stat(source[1]).st_mtime_ns))
+            else:
+                logging.log(logging.VERBOSE, "  updating: " + file.name)
+                writer.add_file(file.name, source[1], compress)
+
+        for (name, path) in files:
+            if CBFArchive.index_key(name) in sources:
+                logging.log(logging.VERBOSE, "  adding: " + name)
+                writer.add_file(name, path, compress)
+        writer.close()
+
+    archive = None
+    os.replace(tmpName, archiveName)
+
+def packFiles(archiveName, files, version, mode, comment, compress, blockSize):
+    logging.info("Archive: " + archiveName)
+    with open(archiveName, "w+b") as fileWrite:
+        writer = CBFWriter(fileWrite, version, mode, comment, blockSize)
+        for (name, path) in files:
+            logging.log(logging.VERBOSE, "  adding: " + name)
+            writer.add_file(name, path, compress)
+        writer.close()
+
+if __name__ == "__main__":
+    level = logging.INFO
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("archive",
+        help="CBF archive to create")
+    parser.add_argument("files",
+        help="files and directories to pack",
+        nargs="+")
+    parser.add_argument("-u", "--update",
+        help="update existing archive - copy unchanged files verbatim, recompress only changed and new files",
+        action="store_true")
+    parser.add_argument("--checksum",
+        help="in update mode, compare content of files with different timestamp",
+        action="store_true")
+    parser.add_argument("--zbl0",
+        help="create ZBL0 archive (default is ZBL1)",
+        action="store_true")
+    parser.add_argument("--classic",
+        help="create classic ZBL1 archive (without header extension)",
+        action="store_true")
+    parser.add_argument("--comment",
+        help="store COMMENT in extended header")
+    parser.add_argument("--store",
+        help="do not compress files",
+        action="store_true")
+    parser.add_argument("--block-size",
+        help="size of LZW block (default: {})".format(CBFWriter.Default.blockSize),
+        type=int, default=CBFWriter.Default.blockSize)
+    parser.add_argument("--verify",
+        help="read created archive back and compare it with packed files",
+        action="store_true")
+    parser.add_argument("-v", "--verbose",
+        help="verbose mode ON",
+        action="store_true")
+    args = parser.parse_args()
+
+    if args.verbose:
+        level = logging.VERBOSE
+
+    logging.basicConfig(level=level, format="%(message)s")
+
+    version = CBFArchive.Version.ZBL0 if args.zbl0 else CBFArchive.Version.ZBL1
+    mode = CBFArchive.Mode.classic if args.classic else CBFArchive.Mode.extended
+    files = collectFiles(args.files)
+
+    try:
+        if args.update:
+            updateArchive(args.archive, files, not args.store, args.block_size, args.checksum)
+        else:
+            packFiles(args.archive, files, version, mode, args.comment, not args.store, args.block_size)
+    except (OSError, RuntimeError) as e:
+        logging.error(e)
+        sys.exit(1)
+
+    if args.verify and not verifyArchive(args.archive, files):
+        sys.exit(1)
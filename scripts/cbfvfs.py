@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  version 2 as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+"""
+cbfvfs.py - virtual filesystem over CBF archives and directories
+"""
+
+import sys
+import argparse
+import os
+import ntpath
+import logging
+
+from cbf import CBFArchive, CBFFile, CBFIndexCache, map_file, filetime
+
+__author__ = "Jan Havran"
+
+class VFSEntry(object):
+    """ File of virtual filesystem (stored in archive or in directory) """
+    def __init__(self, mount, name, size, dateTime, offset=0, storedSize=0, compressed=0):
+        self.mount = mount
+        self.name = name
+        self.size = size
+        self.dateTime = dateTime
+        self.offset = offset
+        self.storedSize = storedSize
+        self.compressed = compressed
+
+    def read(self):
+        return self.mount.read(self)
+
+class VFSMount(object):
+    """ Mounted archive or directory """
+    def __init__(self, path, dataCache=None):
+        self.path = path
+        self.isDir = os.path.isdir(path)
+        self.fileVer = None
+        self.fileData = None
+        self.identity = None
+        self.dataCache = dataCache
+
+    def entries(self, cache=None):
+        """ Return list of VFSEntry for all files of this mount """
+        entries = []
+
+        if self.isDir:
+            for (root, dirs, fileNames) in os.walk(self.path):
+                for fileName in fileNames:
+                    filePath = os.path.join(root, fileName)
+                    st = os.stat(filePath)
+                    name = os.path.relpath(filePath, self.path).replace(os.sep, "\\")
+                    entries.append(VFSEntry(self, name, st.st_size, filetime(st.st_mtime_ns)))
+        else:
+            # Only table of files is kept, archive is mapped again on first read
+            archive = CBFArchive.open(self.path, cache)
+            self.fileVer = archive.fileVer
+            self.identity = archive.identity()
+            for file in archive.fileList:
+                entries.append(VFSEntry(self, file.name, file.size, file.dateTime,
+                    file.offset, len(file.data), file.compressed))
+
+        return entries
+
+    def read(self, entry):
+        if self.isDir:
+            with open(os.path.join(self.path, *entry.name.split("\\")), "rb") as f:
+                return f.read()
+
+        if self.fileData is None:
+            self.fileData = map_file(self.path)
+        file = CBFFile(self.fileVer, entry.name, entry.size,
+            self.fileData[entry.offset:entry.offset + entry.storedSize],
+            entry.compressed, entry.offset, entry.dateTime)
+        if self.dataCache is None:
+            return file.read()
+        return self.dataCache.read((self.identity, entry.offset), file.read)
+
+class VFS(object):
+    """
+    Layered filesystem merging archives and directories.
+
+    Mounts are ordered by priority - file found in earlier mount hides files
+    of the same (case-insensitive) name in later mounts. Paths are resolved
+    by single lookup in merged index, archives are mapped only when a file
+    is read from them. Files extracted from archives may be kept in CBFDataCache.
+    """
+
+    def __init__(self, mounts=[], cache=None, dataCache=None):
+        self.mounts = []
+        self.index = dict()
+        self.dirs = {"": dict()}
+        self.cache = cache
+        self.dataCache = dataCache
+        for path in mounts:
+            self.mount(path)
+
+    def mount(self, path):
+        """ Mount archive or directory with the lowest priority """
+        mount = VFSMount(path, self.dataCache)
+        self.mounts.append(mount)
+
+        for entry in mount.entries(self.cache):
+            key = CBFArchive.index_key(entry.name)
+            if key in self.index:
+                continue
+            self.index[key] = entry
+
+            # register file and its parent directories into directory index
+            (dirName, baseName) = ntpath.split(entry.name)
+            self.dirs.setdefault(CBFArchive.index_key(dirName), dict()).setdefault(baseName.lower(), baseName)
+            while dirName:
+                (parentName, baseName) = ntpath.split(dirName)
+                parent = self.dirs.setdefault(CBFArchive.index_key(parentName), dict())
+                parent.setdefault(baseName.lower(), baseName + "\\")
+                dirName = parentName
+
+    def stat(self, name):
+        """ Return VFSEntry of given file, raise KeyError if there is none """
+        return self.index[CBFArchive.index_key(name)]
+
+    def exists(self, name):
+        return CBFArchive.index_key(name) in self.index
+
+    def read(self, name):
+        return self.stat(name).read()
+
+    def listdir(self, dirName=""):
+        """
+        Return sorted names of files and directories (with trailing backslash)
+        in given directory, raise KeyError if there is none
+        """
+        return sorted(self.dirs[CBFArchive.index_key(dirName).strip("\\")].values(), key=str.lower)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--mount",
+        help="mount archive or directory (earlier mounts have higher priority)",
+        action="append", required=True)
+    parser.add_argument("--cache",
+        help="use index cache of archive tables",
+        action="store_true")
+    parser.add_argument("command",
+        help="stat - print file details, ls - list directory, cat - write file to stdout",
+        choices=["stat", "ls", "cat"])
+    parser.add_argument("path",
+        nargs="?", default="")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    vfs = VFS(args.mount, CBFIndexCache() if args.cache else None)
+
+    try:
+        if args.command == "stat":
+            entry = vfs.stat(args.path)
+            print("{}\t{}\t{}\t{}".format(entry.name, entry.size, entry.dateTime, entry.mount.path))
+        elif args.command == "ls":
+            for name in vfs.listdir(args.path):
+                print(name)
+        else:
+            sys.stdout.buffer.write(vfs.read(args.path))
+    except KeyError:
+        logging.error("No such file or directory: " + args.path)
+        sys.exit(1)